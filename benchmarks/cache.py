@@ -0,0 +1,94 @@
+""" Warm cache load and token write times of the item cache, against the single json file it replaced.
+
+The json file held every key of a backend, with whole server items under each item key, so a
+warm run decoded all of it and saving the login token encoded all of it again.
+
+    python benchmarks/cache.py [--items 10000 100000 1000000] [--runs 3]
+"""
+import argparse
+import datetime
+import json
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+import fakes
+from jellyshuf.cache import Cache, ItemTable
+
+DATE = datetime.date.today().strftime('%d/%m/%Y')
+
+def best_ms(fn, runs: int) -> float:
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times) * 1000
+
+def song_item(library: fakes.Library, i: int) -> dict:
+    # roughly what /Items returned per song before Fields was narrowed down
+    artist, album, name, genre = library.song(i)
+    return {
+        'Name': name, 'ServerId': 'bench', 'Id': 's{}'.format(i), 'RunTimeTicks': 2400000000,
+        'IsFolder': False, 'Type': 'Audio', 'Album': album, 'AlbumArtist': artist, 'Genres': [genre],
+        'Artists': [artist], 'ArtistItems': [{'Name': artist, 'Id': 'ar{}'.format(i)}], 'MediaType': 'Audio',
+        'UserData': {'PlayCount': i % 7, 'IsFavorite': i % 13 == 0, 'Played': False, 'Key': 's{}'.format(i)},
+    }
+
+def song_row(library: fakes.Library, i: int) -> tuple:
+    artist, album, name, genre = library.song(i)
+    return ('s{:09d}'.format(i), artist, album, name, genre, i % 7, i % 13 == 0)
+
+def bench(n: int, runs: int, tmp: Path) -> dict:
+    library = fakes.Library(n)
+
+    legacy_path = tmp.joinpath('legacy.json')
+    legacy = {
+        'token': {'date': DATE, 'data': 'benchtoken'},
+        'songs': {'date': DATE, 'data': [song_item(library, i) for i in range(n)]},
+    }
+    def legacy_write() -> None:
+        with open(legacy_path, 'w') as f:
+            json.dump(legacy, f)
+    def legacy_load() -> None:
+        with open(legacy_path) as f:
+            json.load(f)
+    legacy_write()
+
+    cache = Cache(tmp.joinpath('cache.sqlite'))
+    cache.add_items('songs', (song_row(library, i) for i in range(n)))
+    cache.set('songs', DATE)
+    snapshot_path = tmp.joinpath('songs.items')
+    cache.get_items('songs').dump(snapshot_path)
+
+    result = {
+        'items': n,
+        'json load': best_ms(legacy_load, runs),
+        'json token write': best_ms(legacy_write, runs),
+        'sqlite load': best_ms(lambda: cache.get_items('songs'), runs),
+        'snapshot load': best_ms(lambda: ItemTable.load(snapshot_path), runs),
+        'sqlite token write': best_ms(lambda: cache.set('token', DATE, 'benchtoken'), runs),
+        'json MB': legacy_path.stat().st_size / 2**20,
+        'snapshot MB': snapshot_path.stat().st_size / 2**20,
+    }
+    cache.close()
+    return result
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--items', type=int, nargs='+', default=[10000, 100000], help='Numbers of cached songs')
+    parser.add_argument('--runs', type=int, default=3, help='Take the best of this many runs')
+    args = parser.parse_args()
+
+    columns = ('items', 'json load', 'sqlite load', 'snapshot load', 'json token write', 'sqlite token write', 'json MB', 'snapshot MB')
+    print(' '.join('{:>18}'.format(c) for c in columns))
+    for n in args.items:
+        with tempfile.TemporaryDirectory(prefix='jellyshuf-cache-bench-') as tmp:
+            r = bench(n, args.runs, Path(tmp))
+        print(' '.join('{:>18}'.format(r[c] if c == 'items' else '{:.1f}'.format(r[c])) for c in columns))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
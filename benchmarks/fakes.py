@@ -0,0 +1,307 @@
+""" Local stand-ins for the servers jellyshuf talks to, serving a synthetic library of any size.
+
+Items are generated from their index on every request, so the fakes use little memory even for
+a million tracks. Every 10 tracks make an album and every 10 albums an artist.
+"""
+import json
+import random
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Generator, List, Sequence, Tuple, Union
+from urllib.parse import parse_qs, urlsplit
+
+TRACKS_PER_ALBUM = 10
+ALBUMS_PER_ARTIST = 10
+GENRES = ('Rock', 'Jazz', 'Electronic', 'Classical', 'Hip-Hop', 'Folk')
+# every FAVORITE_EVERY-th album and song is a favourite (starred)
+FAVORITE_EVERY = 13
+
+class Library:
+    def __init__(self, tracks: int) -> None:
+        self.tracks = tracks
+        self.albums = -(-tracks // TRACKS_PER_ALBUM)
+        self.artists = -(-self.albums // ALBUMS_PER_ARTIST)
+
+    def count(self, kind: str) -> int:
+        return {'songs': self.tracks, 'albums': self.albums, 'artists': self.artists}[kind]
+
+    @staticmethod
+    def artist_name(i: int) -> str:
+        return 'Artist {}'.format(i)
+
+    @staticmethod
+    def album_name(i: int) -> str:
+        return 'Album {}'.format(i)
+
+    def song(self, i: int) -> Tuple[str, str, str, str]:
+        # (artist, album, title, genre)
+        album = i // TRACKS_PER_ALBUM
+        artist = album // ALBUMS_PER_ARTIST
+        return self.artist_name(artist), self.album_name(album), 'Track {}'.format(i), GENRES[artist % len(GENRES)]
+
+    def album(self, i: int) -> Tuple[str, str, str]:
+        artist = i // ALBUMS_PER_ARTIST
+        return self.artist_name(artist), self.album_name(i), GENRES[artist % len(GENRES)]
+
+    @staticmethod
+    def is_favorite(i: int) -> bool:
+        return i % FAVORITE_EVERY == 0
+
+    def favorites(self, kind: str) -> Sequence[int]:
+        return range(0, self.count(kind), FAVORITE_EVERY)
+
+    def indices(self, kind: str, genre: Union[str, None] = None) -> Sequence[int]:
+        # albums or songs of genre, which goes by artist; years and ratings are not faked
+        if genre is None:
+            return range(self.count(kind))
+        if genre not in GENRES:
+            return []
+        per_artist = ALBUMS_PER_ARTIST * (TRACKS_PER_ALBUM if kind == 'songs' else 1)
+        return [i for artist in range(GENRES.index(genre), self.artists, len(GENRES))
+            for i in range(artist * per_artist, min((artist + 1) * per_artist, self.count(kind)))]
+
+class Stats:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes_sent = 0
+
+    def add(self, sent: int) -> None:
+        with self.lock:
+            self.requests += 1
+            self.bytes_sent += sent
+
+class JsonHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def send_json(self, body, status: int = 200) -> None:
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        self.server.stats.add(len(data))
+
+    def query(self) -> Tuple[str, Dict[str, str]]:
+        parts = urlsplit(self.path)
+        return parts.path, {k: v[-1] for k, v in parse_qs(parts.query).items()}
+
+    @staticmethod
+    def window(indices: Sequence[int], start: int, limit: int, shuffle: bool) -> List[int]:
+        if shuffle:
+            return random.sample(indices, min(limit, len(indices)))
+        return list(indices[start:start + limit])
+
+    @classmethod
+    def jellyfin_window(cls, indices: Sequence[int], q: Dict[str, str]) -> List[int]:
+        return cls.window(indices, int(q.get('StartIndex', 0)), int(q.get('Limit', len(indices))), q.get('SortBy') == 'Random')
+
+    @classmethod
+    def subsonic_random(cls, indices: Sequence[int], q: Dict[str, str]) -> List[int]:
+        # like most servers, cap random lists at 500
+        return cls.window(indices, 0, min(int(q.get('size', 10)), 500), True)
+
+class JellyfinHandler(JsonHandler):
+    USER_ID = 'benchuser'
+
+    def do_POST(self) -> None:
+        path, _ = self.query()
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if path == '/Users/AuthenticateByName':
+            self.send_json({'AccessToken': 'benchtoken', 'User': {'Id': self.USER_ID}})
+        else:
+            self.send_json({}, 404)
+
+    def do_GET(self) -> None:
+        path, q = self.query()
+        lib = self.server.library
+        if path == '/Users/Me':
+            self.send_json({'Id': self.USER_ID})
+        elif path == '/Users/{}/Views'.format(self.USER_ID):
+            self.send_json({'Items': [{'Name': 'Music', 'Id': 'music', 'CollectionType': 'music'}]})
+        elif path == '/Artists/AlbumArtists':
+            total = lib.artists
+            items = [{'Id': 'ar{}'.format(i), 'Name': lib.artist_name(i), 'Type': 'MusicArtist'}
+                for i in self.jellyfin_window(range(total), q)]
+            self.send_json({'Items': items, 'TotalRecordCount': total})
+        elif path == '/Items':
+            kind = 'songs' if q.get('IncludeItemTypes') == 'Audio' else 'albums'
+            indices = lib.indices(kind, q.get('Genres'))
+            total = len(indices)
+            if 'MinDateLastSaved' in q:
+                # nothing changes on the fake server
+                items = []
+            elif kind == 'songs':
+                items = []
+                for i in self.jellyfin_window(indices, q):
+                    artist, album, name, genre = lib.song(i)
+                    items.append({'Id': 's{}'.format(i), 'Name': name, 'Album': album, 'AlbumArtist': artist,
+                        'Genres': [genre], 'Type': 'Audio', 'UserData': {'PlayCount': i % 7, 'IsFavorite': lib.is_favorite(i)}})
+            else:
+                items = []
+                for i in self.jellyfin_window(indices, q):
+                    artist, name, genre = lib.album(i)
+                    items.append({'Id': 'al{}'.format(i), 'Name': name, 'AlbumArtist': artist,
+                        'Genres': [genre], 'Type': 'MusicAlbum', 'UserData': {'PlayCount': 0, 'IsFavorite': lib.is_favorite(i)}})
+            self.send_json({'Items': items, 'TotalRecordCount': total})
+        else:
+            self.send_json({}, 404)
+
+class SubsonicHandler(JsonHandler):
+    STARRED = '2024-01-01T00:00:00.000Z'
+
+    def ok(self, **body) -> None:
+        self.send_json({'subsonic-response': {'status': 'ok', 'version': '1.16.1', 'type': 'fake', **body}})
+
+    def album(self, i: int) -> dict:
+        artist, name, genre = self.server.library.album(i)
+        album = {'id': 'al{}'.format(i), 'artist': artist, 'title': name, 'genre': genre}
+        if self.server.library.is_favorite(i):
+            album['starred'] = self.STARRED
+        return album
+
+    def song(self, i: int) -> dict:
+        artist, album, name, genre = self.server.library.song(i)
+        song = {'id': 's{}'.format(i), 'artist': artist, 'album': album, 'title': name,
+            'path': '{}/{}/{}.flac'.format(artist, album, name), 'genre': genre}
+        if self.server.library.is_favorite(i):
+            song['starred'] = self.STARRED
+        return song
+
+    def do_GET(self) -> None:
+        path, q = self.query()
+        lib = self.server.library
+        endpoint = path.rpartition('/')[2]
+        if endpoint == 'ping':
+            self.ok()
+        elif endpoint == 'getScanStatus':
+            self.ok(scanStatus={'scanning': False, 'count': lib.tracks})
+        elif endpoint == 'getMusicFolders':
+            self.ok(musicFolders={'musicFolder': [{'id': 1, 'name': 'Music'}]})
+        elif endpoint == 'getAlbumList':
+            start, size = int(q.get('offset', 0)), min(int(q.get('size', 10)), 500)
+            if q.get('type') == 'byGenre':
+                picked = self.window(lib.indices('albums', q.get('genre')), start, size, False)
+            elif q.get('type') == 'starred':
+                picked = self.window(lib.favorites('albums'), start, size, False)
+            else:
+                picked = self.subsonic_random(lib.indices('albums'), q)
+            self.ok(albumList={'album': [self.album(i) for i in picked]})
+        elif endpoint == 'getRandomSongs':
+            picked = self.subsonic_random(lib.indices('songs', q.get('genre')), q)
+            self.ok(randomSongs={'song': [self.song(i) for i in picked]})
+        elif endpoint == 'getStarred':
+            # everything starred, in one response
+            self.ok(starred={'artist': [], 'album': [self.album(i) for i in lib.favorites('albums')],
+                'song': [self.song(i) for i in lib.favorites('songs')]})
+        elif endpoint == 'getIndexes':
+            if 'ifModifiedSince' in q:
+                self.ok(indexes={'lastModified': 1})
+                return
+            artists = [{'id': 'ar{}'.format(i), 'name': lib.artist_name(i)} for i in range(lib.artists)]
+            self.ok(indexes={'lastModified': 1, 'index': [{'name': 'A', 'artist': artists}]})
+        else:
+            self.send_json({}, 404)
+
+class HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler, library: Library) -> None:
+        super().__init__(('127.0.0.1', 0), handler)
+        self.library = library
+        self.stats = Stats()
+
+# where each backend's paths live in the fake mpd database, see MPDHandler.tree
+MPD_PREFIXES = {'Jellyfin/Music': '', 'Subsonic/Directories': '.flac'}
+
+class MPDHandler(socketserver.StreamRequestHandler):
+    # just enough of the mpd protocol for jellyshuf: every command succeeds, the queue stays empty, and the
+    # server's library is listed under both backends' prefixes. Like mpd, commands in a command list are
+    # only run (and answered, in one write) once the list ends.
+    def handle(self) -> None:
+        self.wfile.write(b'OK MPD 0.23.5\n')
+        in_list = None
+        for line in self.rfile:
+            command = line.decode('utf-8').rstrip('\n')
+            name = command.split(' ', 1)[0]
+            if name == 'close':
+                return
+            if name in ('command_list_begin', 'command_list_ok_begin'):
+                in_list = []
+                continue
+            if name == 'command_list_end':
+                self.wfile.write(b''.join(self.run(command) + b'list_OK\n' for command in in_list) + b'OK\n')
+                in_list = None
+                continue
+            if in_list is not None:
+                in_list.append(command)
+                continue
+            self.wfile.write(self.run(command) + b'OK\n')
+
+    def run(self, command: str) -> bytes:
+        name, _, arg = command.partition(' ')
+        arg = arg.strip('"')
+        if name in ('add', 'playlistadd'):
+            self.server.record_add()
+        elif name == 'stats':
+            return b'db_update: 1\n'
+        elif name in ('lsinfo', 'listall') and self.server.library is not None:
+            lines = []
+            for kind, path in self.tree(arg, name == 'listall'):
+                lines.append('{}: {}\n'.format(kind, path))
+                if name == 'lsinfo' and kind == 'directory':
+                    lines.append('Last-Modified: 2024-01-01T00:00:00Z\n')
+            return ''.join(lines).encode('utf-8')
+        return b''
+
+    def tree(self, path: str, recursive: bool) -> Generator[Tuple[str, str], None, None]:
+        for prefix, suffix in MPD_PREFIXES.items():
+            if path == prefix or path.startswith(prefix + '/'):
+                yield from self.walk(prefix, suffix, path[len(prefix)+1:].split('/') if path != prefix else [], recursive)
+
+    def walk(self, prefix: str, suffix: str, parts: List[str], recursive: bool) -> Generator[Tuple[str, str], None, None]:
+        # prefix/Artist i/Album j/Track k, with suffix on tracks
+        lib = self.server.library
+        path = '/'.join([prefix, *parts])
+        if not parts:
+            children = [('directory', lib.artist_name(a)) for a in range(lib.artists)]
+        elif len(parts) == 1:
+            a = int(parts[0].rpartition(' ')[2])
+            children = [('directory', lib.album_name(al))
+                for al in range(a * ALBUMS_PER_ARTIST, min((a + 1) * ALBUMS_PER_ARTIST, lib.albums))]
+        else:
+            al = int(parts[1].rpartition(' ')[2])
+            children = [('file', 'Track {}{}'.format(t, suffix))
+                for t in range(al * TRACKS_PER_ALBUM, min((al + 1) * TRACKS_PER_ALBUM, lib.tracks))]
+        for kind, name in children:
+            yield kind, '{}/{}'.format(path, name)
+            if recursive and kind == 'directory':
+                yield from self.walk(prefix, suffix, [*parts, name], recursive)
+
+class MPDServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self) -> None:
+        super().__init__(('127.0.0.1', 0), MPDHandler)
+        self.library = None
+        self.reset()
+
+    def reset(self) -> None:
+        self.adds = 0
+        self.first_add = None
+
+    def record_add(self) -> None:
+        self.adds += 1
+        if self.first_add is None:
+            self.first_add = time.time()
+
+def start(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
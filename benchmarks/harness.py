@@ -0,0 +1,125 @@
+""" End to end benchmark of jellyshuf against local fake Jellyfin, Subsonic and MPD servers.
+
+Every run is a fresh `jellyshuf` process with its own config and cache directories, so the cold
+runs include interpreter startup, login and the full library download, and the warm runs that
+follow reuse the cache the cold run left behind.
+
+    python benchmarks/harness.py --tracks 10000 100000 --size 100 [-- extra jellyshuf args]
+
+Reported per backend, type and cache state: time to first add received by the fake MPD server,
+total wall time, peak RSS of the jellyshuf process, adds received and HTTP requests and bytes served.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+import fakes
+
+BACKENDS = {
+    # cli name: (config file prefix, handler, library id)
+    'jf': ('jellyfin', fakes.JellyfinHandler, 'music'),
+    'ss': ('Subsonic', fakes.SubsonicHandler, 1),
+}
+TYPES = ('albums', 'artists', 'songs')
+
+# runs jellyshuf.cli() in the child and reports its peak RSS on the last line of stderr
+RUNNER = '''
+import json, resource, sys
+import jellyshuf
+sys.argv = ['jellyshuf'] + sys.argv[1:]
+try:
+    jellyshuf.cli()
+finally:
+    print(json.dumps({'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}), file=sys.stderr)
+'''
+
+def write_config(home: Path, backend: str, url: str, mpd_port: int) -> None:
+    prefix, _, library = BACKENDS[backend]
+    config_dir = home.joinpath('config', 'jellyshuf')
+    config_dir.mkdir(parents=True, exist_ok=True)
+    with open(config_dir.joinpath('{}_config.json'.format(prefix)), 'w') as f:
+        json.dump({
+            'url': url,
+            'user': 'bench',
+            'password': 'bench',
+            'library': library,
+            'use_keyring': False,
+            'mpd_host': '127.0.0.1',
+            'mpd_port': str(mpd_port),
+        }, f)
+
+def run_once(home: Path, argv: list, http: fakes.HTTPServer, mpd: fakes.MPDServer) -> dict:
+    env = {
+        **os.environ,
+        'XDG_CONFIG_HOME': str(home.joinpath('config')),
+        'XDG_CACHE_HOME': str(home.joinpath('cache')),
+        'XDG_RUNTIME_DIR': str(home),
+    }
+    mpd.reset()
+    requests, sent = http.stats.requests, http.stats.bytes_sent
+    start = time.time()
+    res = subprocess.run([sys.executable, '-c', RUNNER, *argv], env=env, capture_output=True, text=True)
+    end = time.time()
+    if res.returncode != 0:
+        raise RuntimeError('jellyshuf {} failed:\n{}'.format(' '.join(argv), res.stderr))
+
+    return {
+        'first_add_s': None if mpd.first_add is None else mpd.first_add - start,
+        'total_s': end - start,
+        'peak_rss_mb': json.loads(res.stderr.strip().splitlines()[-1])['maxrss_kb'] / 1024,
+        'adds': mpd.adds,
+        'requests': http.stats.requests - requests,
+        'bytes': http.stats.bytes_sent - sent,
+    }
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tracks', type=int, nargs='+', default=[10000], help='Library sizes to benchmark')
+    parser.add_argument('--size', type=int, default=100, help='Number of items each run adds')
+    parser.add_argument('--backends', nargs='+', choices=BACKENDS, default=list(BACKENDS))
+    parser.add_argument('--types', nargs='+', choices=TYPES, default=list(TYPES))
+    parser.add_argument('--json', type=Path, help='Also write the results to this file')
+    parser.add_argument('extra', nargs=argparse.REMAINDER, help='Extra arguments for jellyshuf, after --')
+    args = parser.parse_args()
+    extra = [a for a in args.extra if a != '--']
+
+    mpd = fakes.start(fakes.MPDServer())
+    results = []
+    header = '{:>8} {:>3} {:>8} {:>5} {:>10} {:>9} {:>9} {:>6} {:>5} {:>10}'.format(
+        'tracks', 'be', 'type', 'cache', 'first add', 'total', 'rss MB', 'adds', 'reqs', 'bytes')
+    print(header)
+    for tracks in args.tracks:
+        library = fakes.Library(tracks)
+        mpd.library = library
+        for backend in args.backends:
+            http = fakes.start(fakes.HTTPServer(BACKENDS[backend][1], library))
+            url = 'http://127.0.0.1:{}'.format(http.server_address[1])
+            for kind in args.types:
+                with tempfile.TemporaryDirectory(prefix='jellyshuf-bench-') as home:
+                    home = Path(home)
+                    write_config(home, backend, url, mpd.server_address[1])
+                    for cache in ('cold', 'warm'):
+                        r = run_once(home, [*extra, backend, str(args.size), kind], http, mpd)
+                        r.update(tracks=tracks, backend=backend, type=kind, cache=cache)
+                        results.append(r)
+                        print('{:>8} {:>3} {:>8} {:>5} {:>10} {:>9.3f} {:>9.1f} {:>6} {:>5} {:>10}'.format(
+                            tracks, backend, kind, cache,
+                            '-' if r['first_add_s'] is None else '{:.3f}'.format(r['first_add_s']),
+                            r['total_s'], r['peak_rss_mb'], r['adds'], r['requests'], r['bytes']
+                        ))
+            http.shutdown()
+            http.server_close()
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
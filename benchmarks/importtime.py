@@ -0,0 +1,93 @@
+""" Cold start regression check for the jellyshuf entry point.
+
+Runs `python -X importtime -c "import jellyshuf"` in fresh interpreters, takes the best cumulative
+import time of the package, and fails if it is over budget or if any module that should only be
+imported on demand was loaded. Also runs `jellyshuf --stdout` against the fake Jellyfin server of
+fakes.py, which must not load what only adding to mpd needs.
+
+    python benchmarks/importtime.py [--budget-ms 80] [--runs 5]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+# modules only some runs need; importing jellyshuf must not load them
+LAZY_MODULES = ('requests', 'musicpd', 'keyring', 'jellyshuf.jellyfin', 'jellyshuf.sonic', 'jellyshuf.daemon')
+# modules a --stdout run must not load, as it never talks to mpd
+STDOUT_LAZY_MODULES = ('musicpd', 'jellyshuf.resolve', 'jellyshuf.daemon')
+
+# runs jellyshuf.cli() in the child and reports the modules it loaded on the last line of stderr
+STDOUT_RUNNER = '''
+import sys
+import jellyshuf
+sys.argv = ['jellyshuf'] + sys.argv[1:]
+try:
+    jellyshuf.cli()
+finally:
+    print(' '.join(sys.modules), file=sys.stderr)
+'''
+
+def import_time_us() -> int:
+    res = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import jellyshuf'],
+        capture_output=True, text=True, check=True
+    )
+    # lines look like "import time:  self [us] | cumulative | imported package"
+    for line in res.stderr.splitlines():
+        fields = [f.strip() for f in line.split('|')]
+        if len(fields) == 3 and fields[2] == 'jellyshuf':
+            return int(fields[1])
+    raise RuntimeError('jellyshuf missing from -X importtime output:\n' + res.stderr)
+
+def loaded_lazy_modules() -> list:
+    res = subprocess.run(
+        [sys.executable, '-c', 'import sys, jellyshuf; print(" ".join(sys.modules))'],
+        capture_output=True, text=True, check=True
+    )
+    loaded = set(res.stdout.split())
+    return [m for m in LAZY_MODULES if m in loaded]
+
+def stdout_lazy_modules() -> list:
+    sys.path.insert(0, str(Path(__file__).parent))
+    import fakes
+    import harness
+    http = fakes.start(fakes.HTTPServer(fakes.JellyfinHandler, fakes.Library(1000)))
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            home = Path(tmp)
+            # no mpd server: a --stdout run that connects to one fails
+            harness.write_config(home, 'jf', 'http://127.0.0.1:{}'.format(http.server_address[1]), 0)
+            env = {**os.environ, 'XDG_CONFIG_HOME': str(home.joinpath('config')), 'XDG_CACHE_HOME': str(home.joinpath('cache'))}
+            res = subprocess.run([sys.executable, '-c', STDOUT_RUNNER, '--stdout', 'jf', '10', 'songs'],
+                env=env, capture_output=True, text=True, check=True)
+    finally:
+        http.shutdown()
+    loaded = set(res.stderr.splitlines()[-1].split())
+    return [m for m in STDOUT_LAZY_MODULES if m in loaded]
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--budget-ms', type=float, default=80, help='Maximum cumulative import time of jellyshuf')
+    parser.add_argument('--runs', type=int, default=5, help='Number of fresh interpreters to take the best time of')
+    args = parser.parse_args()
+
+    best = min(import_time_us() for _ in range(args.runs)) / 1000
+    print('import jellyshuf: {:.1f} ms (budget {:.1f} ms)'.format(best, args.budget_ms))
+    failed = best > args.budget_ms
+
+    lazy = loaded_lazy_modules()
+    if lazy:
+        print('imported eagerly: {}'.format(', '.join(lazy)))
+        failed = True
+
+    lazy = stdout_lazy_modules()
+    if lazy:
+        print('imported by a --stdout run: {}'.format(', '.join(lazy)))
+        failed = True
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,24 +1,38 @@
 import logging
-from pathlib import Path
-from re import template
-from typing import List, Mapping, Union
+import sys
+from collections import deque
+from typing import Callable, List, Mapping, Union
 import argparse
-from importlib.metadata import version
+from itertools import islice
 
-import musicpd
-
-from jellyshuf import jellyfin, sonic, base
+# Only what every run needs is imported here; the backends (and with them requests) 
+# are imported once they are known to be needed, see make_client.
+from jellyshuf import base, filters, sampling, timings
 
 JSON = Union[str, int, float, bool, None, Mapping[str, 'JSON'], List['JSON']]
 logger = logging.getLogger(__name__)
 
-def parse_args(bin_name) -> argparse.ArgumentParser: 
+class VersionAction(argparse.Action): 
+    # like action='version', but only looks up the installed version when asked for it
+    def __init__(self, option_strings, dest=argparse.SUPPRESS, default=argparse.SUPPRESS, help=None): 
+        super().__init__(option_strings, dest=dest, default=default, nargs=0, help=help)
+
+    def __call__(self, parser, namespace, values, option_string=None): 
+        # on stdout, as action='version' prints it
+        print(base.CONSTANTS.APP_VERSION)
+        parser.exit()
+
+def parse_args(bin_name, argv=None) -> argparse.ArgumentParser: 
     parser = argparse.ArgumentParser(
         description='Randomly add items to mpd queue from jellyfin or subsonic server.'
     )
     parser.add_argument('--stdout', action='store_true',
         help='Instead of adding retrieved paths to mpd queue, emits them to stdout (line separated)'
     )
+    parser.add_argument('--playlist', metavar='NAME',
+        help='''Save the items as mpd playlist NAME (songs to mpd_playlist_dir if set, otherwise through mpd), 
+                then load it into the queue at once; for large batches'''
+    )
     parser.add_argument('-i', '--interactive', action='store_true',
         help='''If not in stdout mode, interactively confirms albums before adding them;
                 {name} runs until NUMBER has been added to queue.'''.format(name=bin_name)                
@@ -32,38 +46,149 @@ def parse_args(bin_name) -> argparse.ArgumentParser:
     parser.add_argument('-c', '--clear', action='store_true', 
         help='Clear mpd queue before adding items'
     )
+    parser.add_argument('-p', '--pipeline', action='store_true',
+        help='Fetch items from the server while adding them to mpd; with --start, playback starts after the first batch'
+    )
+    parser.add_argument('-a', '--allow-duplicates', action='store_true',
+        help='Add items even if they are already in the mpd queue or were added recently'
+    )
+    parser.add_argument('--weight', choices=sampling.WEIGHTS,
+        help='Favour cached items with more plays or marked as favourite'
+    )
+    parser.add_argument('--per-artist', type=int, metavar='K',
+        help='Add at most K items by the same artist'
+    )
+    parser.add_argument('--per-album', type=int, metavar='K',
+        help='Add at most K items from the same album'
+    )
+    parser.add_argument('--by-genre', action='store_true',
+        help='Spread items evenly across genres'
+    )
+    parser.add_argument('--continue', dest='resume', action='store_true',
+        help='Carry on through the shuffled order earlier --continue runs took items from, so no item comes up twice until all have'
+    )
+    parser.add_argument('--seed', type=int,
+        help='Start the shuffled order given by SEED from its beginning (the same for the same library); --continue carries on from there'
+    )
+    parser.add_argument('--genre', metavar='NAME',
+        help='Only add albums or songs of genre NAME'
+    )
+    parser.add_argument('--year-range', type=year_range, metavar='YEARS',
+        help='Only add albums or songs released in YEARS: a year, a range such as 1990-1999 or a decade such as 1990s'
+    )
+    parser.add_argument('--favorites', action='store_true',
+        help='Only add albums or songs marked as favourite (starred)'
+    )
+    parser.add_argument('--min-rating', type=int, choices=range(1, 6), metavar='STARS',
+        help='Only add albums or songs rated at least STARS out of 5 (on jellyfin, twice that out of 10 community rating)'
+    )
     parser.add_argument('--config', action='store_true', 
         help='Run interactive config (overwriting existing settings on disk), then exit'
     )
     parser.add_argument('--default-config', action='store_true',
         help='Replace config on disk with default one' 
     )
-    parser.add_argument('-v', '--version', action='version', 
-        help='Print version and exit',
-        version=version(base.CONSTANTS.PROJECT_NAME)
+    parser.add_argument('--daemon', action='store_true',
+        help='Keep logins and cached libraries in memory and serve --remote runs over a unix socket'
+    )
+    parser.add_argument('--remote', action='store_true',
+        help='Run through a running {name} --daemon, falling back to running locally'.format(name=bin_name)
+    )
+    parser.add_argument('--refresh-cache', action='store_true',
+        help='Refresh the expired caches of backend, then exit (e.g. from a systemd timer)'
+    )
+    parser.add_argument('--timings', action='store_true',
+        help='Print how long each stage of the run took, with items and bytes handled, to stderr'
     )
-    parser.add_argument('backend', type=str, 
-        help='Server backend to use (either subsonic/sonic/ss or jellyfin/jf)'
+    parser.add_argument('--trace', metavar='FILE',
+        help='Write the timed stages to FILE in Chrome trace format (open with chrome://tracing or Perfetto)'
     )
-    parser.add_argument('size', type=int, 
+    parser.add_argument('--profile', metavar='FILE',
+        help='Run under cProfile and write the stats to FILE (read with python -m pstats FILE)'
+    )
+    parser.add_argument('-v', '--version', action=VersionAction, 
+        help='Print version and exit'
+    )
+    parser.add_argument('backend', type=str, nargs='?',
+        help='''Server backend to use (either subsonic/sonic/ss or jellyfin/jf), optionally with @PROFILE for another 
+                server or library of it (e.g. jf@work); several comma separated, each optionally with :WEIGHT, a multiple 
+                of its share by size (e.g. jf,jf@work:2,ss), draw from all of them at once'''
+    )
+    parser.add_argument('size', type=int, nargs='?',
         help='Number of items to add to queue'     
     )
-    parser.add_argument('type', type=str, 
+    parser.add_argument('type', type=str, nargs='?',
         help='Type of items to add (either albums, artists or songs)'                   
     )
-    return parser, parser.parse_args()
+    return parser, parser.parse_args(argv)
 
 
+def year_range(s: str): 
+    try: 
+        return filters.parse_years(s)
+    except ValueError: 
+        raise argparse.ArgumentTypeError('not a year, range of years or decade: {}'.format(s))
+
+def make_backend(backend: str, size: int, profile: Union[str, None] = None) -> Union[base.CliClient, None]: 
+    if backend in ('subsonic', 'sonic', 'ss'):
+        from jellyshuf import sonic
+        return sonic.CliClient(size, profile)
+    elif backend in ('jellyfin', 'jf'): 
+        from jellyshuf import jellyfin
+        return jellyfin.CliClient(size, profile)
+    return None
+
+def make_client(spec: str, size: int) -> Union[base.CliClient, None]: 
+    # one backend, or several (see fanout.parse_sources) drawn from together
+    if ',' not in spec and ':' not in spec: 
+        backend, _, profile = spec.partition('@')
+        return make_backend(backend, size, profile or None)
+
+    from jellyshuf import fanout
+    try: 
+        sources = fanout.parse_sources(spec)
+    except ValueError: 
+        return None
+    clients = [make_backend(source.backend, size, source.profile) for source in sources]
+    if None in clients: 
+        return None
+    return fanout.MultiClient(clients, [source.weight for source in sources])
+
 def cli() -> None:
     bin_name = 'jellyshuf'
     parser, args = parse_args(bin_name)
 
-    if args.backend in ('subsonic', 'sonic', 'ss'):
-        client = sonic.CliClient(args.size)
-    elif args.backend in ('jellyfin', 'jf'): 
-        client = jellyfin.CliClient()
-    else: 
-        logger.error('\nServer backend not one of subsonic or jellyfin')
+    if args.profile is None: 
+        main(bin_name, parser, args)
+        return
+    
+    import cProfile
+    profiler = cProfile.Profile()
+    try: 
+        profiler.runcall(main, bin_name, parser, args)
+    finally: 
+        profiler.dump_stats(args.profile)
+        print('Wrote profile to {}'.format(args.profile), file=sys.stderr)
+
+def main(bin_name: str, parser: argparse.ArgumentParser, args: argparse.Namespace) -> None: 
+    if args.daemon: 
+        serve(bin_name)
+        return
+
+    if args.backend is None or ((args.size is None or args.type is None) 
+            and not (args.config or args.default_config or args.refresh_cache)): 
+        parser.error('backend, size and type are required')
+
+    if args.remote: 
+        from jellyshuf import daemon
+        argv = [arg for arg in sys.argv[1:] if arg != '--remote']
+        if daemon.request(argv): 
+            return
+        logger.info('No daemon listening on {}, running locally'.format(daemon.socket_path()))
+
+    client = make_client(args.backend, args.size)
+    if client is None: 
+        logger.error('\nServer backend not one of subsonic or jellyfin, or malformed list of them')
         parser.print_help()
         return 
 
@@ -75,17 +200,133 @@ def cli() -> None:
     if args.config: 
         client.start(True)
         return
+
+    if args.refresh_cache: 
+        # sources one at a time, each logged in before its caches are checked
+        for source in client.sources(): 
+            source.start()
+            refresh_caches(source)
+        return
     
-    client.start()
+    start_timings(args)
+    with timings.span('connect'): 
+        client.start()
+    run(client, parser, args)
+    report_timings(args)
+
+def start_timings(args: argparse.Namespace) -> None: 
+    if args.timings or args.trace is not None: 
+        timings.enable()
+
+def report_timings(args: argparse.Namespace) -> None: 
+    if args.timings: 
+        print(timings.summary(), file=sys.stderr)
+    if args.trace is not None: 
+        timings.write_trace(args.trace)
+        print('Wrote trace to {}'.format(args.trace), file=sys.stderr)
+    timings.disable()
+
+def serve(bin_name: str) -> None: 
+    from jellyshuf import daemon
+
+    # clients are started on first use and kept, along with their sessions and decoded caches
+    clients = {}
+
+    def run_remote(argv: List[str]) -> None: 
+        parser, args = parse_args(bin_name, argv)
+        if args.backend is None or args.size is None or args.type is None: 
+            parser.error('backend, size and type are required')
+        if args.interactive or args.config or args.default_config or args.daemon: 
+            parser.error('--interactive, --config, --default-config and --daemon cannot be used with --remote')
+        
+        start_timings(args)
+        try: 
+            client = clients.get(args.backend)
+            if client is None: 
+                client = make_client(args.backend, args.size)
+                if client is None: 
+                    parser.error('Server backend not one of subsonic or jellyfin')
+                with timings.span('connect'): 
+                    client.start()
+                for source in client.sources(): 
+                    # expired caches are refreshed by the daemon, straight away
+                    source.refresher = lambda source: daemon.refresh_now()
+                clients[args.backend] = client
+            client.return_size = args.size
+            run(client, parser, args)
+            report_timings(args)
+        finally: 
+            timings.disable()
+
+    # clients of their own for background refreshes, by the spec of the source they refresh
+    refreshers = {}
+
+    def refresh() -> Callable[[], None]: 
+        # Caches are refreshed as a detached --refresh-cache would, on clients (and so sessions and cache connections) 
+        # apart from the ones requests use, so that no request waits behind a download. Requests load the new items 
+        # once they are in, see DataManager.memoized.
+        sources = {source for client in list(clients.values()) for source in client.sources()}
+        for source in sources: 
+            refresher = refreshers.get(source.data.spec)
+            if refresher is None: 
+                refresher = make_client(source.data.spec, source.return_size)
+                refresher.start()
+                refreshers[source.data.spec] = refresher
+            refresh_caches(refresher)
+
+        def finish() -> None: 
+            for source in sources: 
+                source.revalidating = False
+        return finish
+
+    daemon.serve(run_remote, refresh, daemon.REFRESH_INTERVAL)
+
+def refresh_caches(client: base.CliClient) -> None: 
+    # Bring the expired caches of a started client up to date, and build what runs read from them. 
+    # Only libraries that have been used are kept up, and none that another process is writing already; the lock 
+    # is held throughout, so that no other writer can take it between keys and leave a refresh to fetch uncached.
+    with client.data.lock() as locked: 
+        if not locked: 
+            logger.info('Cache of {} is being written by another run'.format(client.data.NAME))
+            return
+        for key in client.data.item_keys(): 
+            if client.data.is_cached(key): 
+                client.refresh(key)
+                client.get_path_index(key)
+    client.revalidating = False
+
+def run(client: base.CliClient, parser: argparse.ArgumentParser, args: argparse.Namespace) -> None: 
+    client.sampling = sampling.Options(args.weight, args.per_artist, args.per_album, args.by_genre, args.resume, args.seed)
+    if client.sampling.is_seeded() and not client.sampling.is_uniform(): 
+        parser.error('--continue and --seed cannot be used with --weight, --per-artist, --per-album or --by-genre')
+    client.filters = filters.Filters(args.genre, args.year_range, args.favorites, args.min_rating)
+    if not client.filters.is_empty() and args.type.casefold() not in filters.TYPES: 
+        logger.warning("Artists are not filtered; --genre, --year-range, --favorites and --min-rating are ignored.")
+    # Subsonic draws filtered albums and starred songs from the cache, everything else from the server's random lists
+    random_list = ((args.type.casefold() == 'albums' and client.filters.key('albums') == 'albums')
+        or (args.type.casefold() == 'songs' and not client.filters.favorites))
+    if ((not client.sampling.is_uniform() or client.sampling.is_seeded()) and random_list 
+            and any(source.data.BACKEND_NAME == 'Subsonic' for source in client.sources())): 
+        logger.warning("Subsonic servers pick random {} themselves; --weight, --per-artist, --per-album, --by-genre, --continue and --seed are ignored.".format(args.type.casefold()))
     
     #sanitisise cli input
     if args.interactive and args.stdout: 
         args.interactive = False
+    if args.playlist is not None and (args.stdout or args.interactive): 
+        parser.error('--playlist cannot be used with --stdout or --interactive')
 
     # stand up objects
+    from jellyshuf import player
+    loading = None
     if not args.stdout:
+        import musicpd
         mpd = musicpd.MPDClient()
-        mpd.connect(client.data.config.mpd_host, client.data.config.mpd_port)
+        with timings.span('mpd.connect'): 
+            mpd.connect(client.data.config.mpd_host, client.data.config.mpd_port)
+            player.no_delay(mpd)
+        if client.data.config.resolve_paths: 
+            from jellyshuf import resolve
+            loading = resolve.start(client.data, (source.data.MPD_PREFIX for source in client.sources()))
 
     # make generator
     try: 
@@ -105,32 +346,82 @@ def cli() -> None:
     if args.clear:
         mpd.clear()
     
-    for _ in range(args.size): 
-        try:     
-            path = next(gen)
-            
-            if args.stdout: 
-                print(path)
-                continue
-            
-            if args.interactive:
-                while not base.CliClient.str_to_bool(input("Would you like to add {} to queue (y/n)? ".format(path))): 
-                    path = next(gen)
-            
+    if loading is not None: 
+        gen = resolve.resolve_all(gen, loading)
+
+    # Paths mpd has taken (or that were printed), for the history; only the most recent of a large batch make it in. 
+    # Runs with --allow-duplicates keep no history.
+    added = None
+    if not args.allow_duplicates: 
+        added = deque(maxlen=max(client.data.config.history_size, 0))
+        with timings.span('mpd.queue') as s: 
+            queued = set() if args.stdout or args.clear else player.queued_paths(mpd)
+            s.add(items=len(queued))
+        gen = player.skip_seen(gen, queued, client.data.get_history(), client.data.cache.path_hash)
+    
+    started = False
+    if args.playlist is not None: 
+        # an m3u file holds songs only, mpd does not expand the album and artist directories in one
+        directory = client.data.config.mpd_playlist_dir if args.type.casefold() == 'songs' else None
+        tried = player.save_playlist(mpd, args.playlist, islice(gen, args.size), client.data.config.mpd_batch_size, 
+            directory, client.data.config.pipeline_depth if args.pipeline else None, added
+        )
+        if tried < args.size: 
+            print("Ran out of new candidate mpd paths.")
+        if tried: 
             try: 
-                mpd.add(path)
-                print('Added {}'.format(path))
-            except musicpd.CommandError as e:
-                print('Failed to add {}'.format(path)) 
+                with timings.span('mpd.load', items=tried): 
+                    mpd.load(args.playlist)
+                print('Loaded playlist {} of {} items'.format(args.playlist, tried))
+            except musicpd.CommandError as e: 
+                # every playlistadd failed, so there is no playlist to load
+                print('Failed to load playlist {}'.format(args.playlist))
                 print(str(e))
+    elif not args.stdout and not args.interactive and args.pipeline: 
+        def start() -> None: 
+            nonlocal started
+            if args.start: 
+                mpd.play()
+                started = True
 
-        except StopIteration: 
+        tried = player.add_pipelined(mpd, islice(gen, args.size), 
+            client.data.config.mpd_batch_size, client.data.config.pipeline_depth, start, added=added
+        )
+        if tried < args.size: 
+            print("Ran out of new candidate mpd paths.")
+    elif not args.stdout and not args.interactive: 
+        if player.add_all(mpd, islice(gen, args.size), client.data.config.mpd_batch_size, added=added) < args.size: 
             print("Ran out of new candidate mpd paths.")
-            break 
+    else: 
+        for _ in range(args.size): 
+            try:     
+                path = next(gen)
+                
+                if args.stdout: 
+                    print(path)
+                    if added is not None: 
+                        added.append(path)
+                    continue
+                
+                if args.interactive:
+                    while not base.CliClient.str_to_bool(input("Would you like to add {} to queue (y/n)? ".format(path))): 
+                        path = next(gen)
+                
+                player.add(mpd, path, added=added)
+
+            except StopIteration: 
+                print("Ran out of new candidate mpd paths.")
+                break 
     
+    if added is not None: 
+        client.data.add_history(added)
+    client.save_cursors()
+
     if args.random: 
         mpd.random()
-    if args.start: 
+    if args.start and not started: 
         mpd.play()
     if not args.stdout:
         mpd.disconnect()
+    if loading is not None: 
+        resolve.finish(loading)
@@ -0,0 +1,3 @@
+from jellyshuf import cli
+
+cli()
@@ -1,22 +1,22 @@
+import contextlib
 import datetime
 import json
 import logging
-import socket
+import random
+from functools import cached_property
 from getpass import getpass
 import uuid
 from abc import ABC, abstractmethod
+import threading
 from pathlib import Path
-from typing import Generator, Union, Mapping, List, Dict
-from importlib.metadata import version
+from typing import Callable, Generator, Iterable, Union, Mapping, List, Dict, Set
 from typing import NamedTuple
 from urllib import parse
 
 from appdirs import AppDirs
-try: 
-    import keyring 
-    HAS_KEYRING = True
-except ModuleNotFoundError: 
-    HAS_KEYRING = False
+
+from jellyshuf import filters, sampling, timings
+from jellyshuf.cache import Cache, ItemRow, ItemTable, PathIndex
 
 JSONDict = Union[str, int, float, bool, None, Mapping[str, 'JSONDict'], List['JSONDict']]
 
@@ -25,13 +25,22 @@ logger = logging.getLogger(__name__)
 class BackendError(Exception): 
     pass
 
-class ConstantTuple(NamedTuple): 
-    PROJECT_NAME: str 
-    AUTHOR:str 
-    SUBSONIC_API_VERSION:str
-    APP_VERSION:str
-    HOSTNAME:str
-CONSTANTS = ConstantTuple('jellyshuf', 'def', '1.16.1', version('jellyshuf'), socket.gethostname())
+class Constants: 
+    PROJECT_NAME: str = 'jellyshuf'
+    AUTHOR: str = 'def'
+    SUBSONIC_API_VERSION: str = '1.16.1'
+
+    # resolved on first use, not on import; most runs never need them
+    @cached_property
+    def APP_VERSION(self) -> str: 
+        from importlib.metadata import version
+        return version(self.PROJECT_NAME)
+
+    @cached_property
+    def HOSTNAME(self) -> str: 
+        import socket
+        return socket.gethostname()
+CONSTANTS = Constants()
 
 class DataManager(ABC):
     @classmethod
@@ -66,14 +75,27 @@ class DataManager(ABC):
         keyring_backend: str = None
         mpd_host: str = None
         mpd_port: str = None
+        mpd_batch_size: int = 100
+        mpd_playlist_dir: str = None
+        pipeline_depth: int = 2000
+        history_size: int = 1000
+        page_size: int = 1000
+        sample_size: int = 500
+        max_connections: int = 4
+        incremental_sync: bool = True
+        resolve_paths: bool = True
+        background_refresh: bool = True
 
         
-    def __init__(self) -> None:
+    def __init__(self, profile: Union[str, None] = None) -> None:
+        # a profile is a second (third, ...) server or library of the same backend, with its own config, cache and password
+        self.NAME = self.BACKEND_NAME if profile is None else f'{self.BACKEND_NAME}@{profile}'
+        self.profile = profile
         appdirs = AppDirs(CONSTANTS.PROJECT_NAME, CONSTANTS.AUTHOR)
-        self.CONFIG_PATH = Path(appdirs.user_config_dir).joinpath(f'{self.BACKEND_NAME}_config.json')
-        self.CACHE_PATH = Path(appdirs.user_cache_dir).joinpath(f'{self.BACKEND_NAME}_cache.json')
-        self.SERVICE_NAME = f'{CONSTANTS.PROJECT_NAME}/{self.BACKEND_NAME}'
-        self.CLIENT_NAME = '{}/{}'.format(self.SERVICE_NAME, CONSTANTS.APP_VERSION)
+        self.CONFIG_PATH = Path(appdirs.user_config_dir).joinpath(f'{self.NAME}_config.json')
+        self.CACHE_DIR = Path(appdirs.user_cache_dir)
+        self.CACHE_PATH = self.CACHE_DIR.joinpath(f'{self.NAME}_cache.sqlite')
+        self.SERVICE_NAME = f'{CONSTANTS.PROJECT_NAME}/{self.NAME}'
         self._freeze_config = True
         
         config = {}
@@ -86,19 +108,14 @@ class DataManager(ABC):
         self.config = self.Config(**config)
 
         self.use_keyring = self.config.use_keyring
-        if not HAS_KEYRING: 
-        # use this instance var instead of updating config value on disk so that if keyring later becomes avilable it will be used
-            self.use_keyring = False 
-        if self.config.keyring_backend is not None: 
-            keyring.set_keyring(self.config.keyring_backend)
-
-        self.cache = {}
-        if self.CACHE_PATH.is_file():
-            with open(self.CACHE_PATH, 'r') as f: 
-                try: 
-                    self.cache = json.load(f)
-                except json.decoder.JSONDecodeError: 
-                    self.CACHE_PATH.unlink()
+        self._keyring = None
+
+        self.cache = Cache(self.CACHE_PATH)
+        self.memo = {}
+        # expired keys served as they are for now, see CliClient.cached
+        self.stale: Set[str] = set()
+        self._lock = threading.RLock()
+        self._held = False
     
     @staticmethod
     def touch_file(path: Path):
@@ -113,45 +130,267 @@ class DataManager(ABC):
     def __getattr__(self, name) -> None:
         self.config.__getattr__(name)
 
+    @property
+    def CLIENT_NAME(self) -> str: 
+        return '{}/{}/{}'.format(CONSTANTS.PROJECT_NAME, self.BACKEND_NAME, CONSTANTS.APP_VERSION)
+
+    @property
+    def spec(self) -> str: 
+        # backend argument that selects this backend and profile again
+        return self.BACKEND_NAME.lower() + ('' if self.profile is None else '@' + self.profile)
+
+    @property
+    def keyring(self): 
+        # keyring is slow to import, so only do so once a password is actually needed
+        if not self.use_keyring: 
+            return None
+        if self._keyring is None: 
+            try: 
+                import keyring 
+            except ModuleNotFoundError: 
+                # use this instance var instead of updating config value on disk so that if keyring later becomes avilable it will be used
+                self.use_keyring = False 
+                return None
+            if self.config.keyring_backend is not None: 
+                keyring.set_keyring(self.config.keyring_backend)
+            self._keyring = keyring
+        return self._keyring
+
     @property
     def password(self) -> str: 
-        if self.use_keyring:
+        keyring = self.keyring
+        if keyring is not None:
             return keyring.get_password(self.SERVICE_NAME, self.config.user)
         else: 
             return self.config.password
     
+    def memoized(self, name: tuple, stamp, load: Callable[[], object]): 
+        # keep decoded cache objects for as long as the entries they came from are unchanged, e.g. in daemon mode
+        hit = self.memo.get(name)
+        if hit is not None and hit[0] == stamp: 
+            return hit[1]
+        value = load()
+        self.memo[name] = (stamp, value)
+        return value
+
+    def is_fresh(self, key: str, cache_days: int) -> bool: 
+        date = self.cache.get_date(key)
+        if date is None: 
+            return False
+        return (datetime.datetime.today() - datetime.datetime.strptime(date, self.DATEFMT)).days < cache_days
+
     def get_cache(self, key: str) -> Union[JSONDict, None]:
         if not self.config.cache:
             return None
         
         cache_days = self.config.cache_days
-        if key == 'token':
+        if key == self.TOKEN_KEY:
             if not self.config.cache_token:
                 return None
             cache_days = 1
-            
-        cache = self.cache.get(key) 
-        if cache is None: 
-            return None 
         
-        if (datetime.datetime.today() - datetime.datetime.strptime(cache['date'], self.DATEFMT)).days < cache_days: 
-            return cache['data']
-        else: 
-            self.cache[key] = None 
-            
+        if self.is_fresh(key, cache_days): 
+            return self.cache.get(key)
         return None
 
-    def save_cache(self, key: str, data: dict) -> None: 
+    def save_cache(self, key: str, data: JSONDict) -> None: 
+        if not self.config.cache: 
+            return
+        with timings.span('cache.save'): 
+            self.cache.set(key, datetime.date.today().strftime(self.DATEFMT), data)
+
+    def has_items(self, key: str) -> bool: 
+        # whether key has been fully downloaded recently, or is being served stale
+        return self.config.cache and (
+            self.is_fresh(key, self.config.cache_days) or (key in self.stale and self.is_cached(key))
+        )
+
+    def is_cached(self, key: str) -> bool: 
+        # whether key has been fully downloaded, however long ago
+        return self.config.cache and self.cache.get_date(key) is not None
+
+    def get_items(self, key: str) -> Union[ItemTable, None]:
+        # (artist, album, name) of every cached item, or None if key has not been fully downloaded recently
+        if not self.has_items(key): 
+            return None
+        return self.memoized(('items', key), self.cache.get_stamp(key), lambda: self.load_items(key))
+
+    def load_items(self, key: str) -> ItemTable: 
+        # From the item table snapshot if there is one for the current items cache (see finish_items), 
+        # otherwise from the database, writing a snapshot for the next run.
+        path = self.cache_file(key, 'items')
+        if self.cache.get_date(self.item_table_key(key)) is not None: 
+            try: 
+                with timings.span('cache.read') as s: 
+                    items = ItemTable.load(path)
+                    s.add(items=len(items))
+                return items
+            except (OSError, ValueError) as e: 
+                logger.info('Rebuilding item table snapshot for {}: {}'.format(key, e))
+
+        with timings.span('cache.read') as s: 
+            items = self.cache.get_items(key)
+            s.add(items=len(items))
+        with timings.span('cache.snapshot', items=len(items)): 
+            items.dump(path)
+        self.save_cache(self.item_table_key(key), None)
+        return items
+
+    def cache_file(self, key: str, suffix: str) -> Path: 
+        return self.CACHE_DIR.joinpath('{}_{}.{}'.format(self.NAME, filters.file_key(key), suffix))
+
+    def item_keys(self) -> List[str]: 
+        # keys that items have been cached under, filtered ones (see filters.Filters.key) included
+        if not self.config.cache: 
+            return []
+        derived = (self.path_index_key(''), self.item_table_key(''), self.cursor_key(''))
+        return [key for key in self.cache.keys() 
+            if filters.kind_of(key) in ('albums', 'artists', 'songs') and not key.endswith(derived)]
+
+    def clear_items(self, key: str) -> None: 
+        if self.config.cache: 
+            self.cache.delete(key)
+            self.clear_derived(key)
+
+    def write_key(self, key: str) -> str: 
+        # Where a full download of key is written: straight to key the first time, otherwise next to the cached 
+        # items, which stay in use (by this or another run) until finish_items swaps the new ones in
+        return '{}.new'.format(key) if self.is_cached(key) else key
+
+    @contextlib.contextmanager
+    def lock(self): 
+        # Held while writing items, so that two runs (or a run and a background refresh) never write the same keys 
+        # at once. Never waits: yields False if another thread or process has it. Readers do not lock. 
+        # The thread holding it can take it again, e.g. the writers called by refresh_caches, which holds it throughout.
+        if not self.config.cache: 
+            yield True
+            return
+        if not self._lock.acquire(blocking=False): 
+            yield False
+            return
+        try: 
+            if self._held: 
+                yield True
+                return
+            with self.file_lock() as locked: 
+                self._held = locked
+                try: 
+                    yield locked
+                finally: 
+                    self._held = False
+        finally: 
+            self._lock.release()
+
+    @contextlib.contextmanager
+    def file_lock(self): 
+        # the lock between processes, see lock
+        try: 
+            import fcntl
+        except ModuleNotFoundError: 
+            yield True # no flock on windows; threads are still kept apart
+            return
+        path = self.CACHE_DIR.joinpath(f'{self.NAME}.lock')
+        self.touch_file(path)
+        with open(path, 'w') as f: 
+            try: 
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError: 
+                yield False
+                return
+            try: 
+                yield True
+            finally: 
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def clear_derived(self, key: str) -> None: 
+        # path index and item table snapshot are only valid for the items cache they were built from
+        self.cache.delete(self.path_index_key(key))
+        self.cache.delete(self.item_table_key(key))
+
+    def count_items(self, key: str) -> int: 
+        return self.cache.count_items(key) if self.config.cache else 0
+
+    def add_items(self, key: str, rows: Iterable[ItemRow]) -> None: 
+        if self.config.cache: 
+            rows = list(rows)
+            with timings.span('cache.write', items=len(rows)): 
+                self.cache.add_items(key, rows)
+    
+    def finish_items(self, key: str, synced: str = None, written: Union[str, None] = None) -> None: 
+        # items under key only count as cached once they have all been added; 
+        # synced is a backend specific marker for where the next incremental sync should start from. 
+        # written is the key they were added under, if not key itself (see write_key).
         if not self.config.cache: 
             return
+        if written is not None and written != key: 
+            with timings.span('cache.swap'): 
+                self.cache.replace_items(key, written, datetime.date.today().strftime(self.DATEFMT), synced)
+        else: 
+            self.save_cache(key, synced)
+        self.clear_derived(key)
+
+    def get_synced(self, key: str) -> Union[str, None]: 
+        # sync marker of a complete (possibly expired) item cache
+        if not self.config.cache or not self.config.incremental_sync: 
+            return None
+        return self.cache.get(key)
+
+    def get_history(self) -> Set[int]: 
+        # hashes of recently added paths, see Cache.path_hash
+        if not self.config.cache or self.config.history_size <= 0: 
+            return set()
+        with timings.span('history.read'): 
+            return self.cache.get_history()
+
+    def add_history(self, paths: Iterable[str]) -> None: 
+        if self.config.cache and self.config.history_size > 0: 
+            with timings.span('history.write'): 
+                self.cache.add_history(paths, self.config.history_size)
+
+    @staticmethod
+    def path_index_key(key: str) -> str: 
+        return '{}.paths'.format(key)
+
+    @staticmethod
+    def item_table_key(key: str) -> str: 
+        return '{}.items'.format(key)
+
+    @staticmethod
+    def cursor_key(key: str) -> str: 
+        return '{}.cursor'.format(key)
+
+    def get_cursor(self, key: str) -> Union[JSONDict, None]: 
+        # cursors do not expire with the items, see sampling.Cursor
+        return self.cache.get(self.cursor_key(key)) if self.config.cache else None
+
+    def save_cursor(self, key: str, state: JSONDict) -> None: 
+        self.save_cache(self.cursor_key(key), state)
+
+    def get_path_index(self, key: str) -> Union[PathIndex, None]: 
+        # a path index is only valid for the items cache it was built from, see finish_items
+        if not self.has_items(key) or self.cache.get_date(self.path_index_key(key)) is None: 
+            return None
+        try: 
+            return self.memoized(
+                ('paths', key), 
+                (self.cache.get_stamp(key), self.cache.get_stamp(self.path_index_key(key))), 
+                lambda: self.open_path_index(key)
+            )
+        except (OSError, ValueError): 
+            return None
+
+    def open_path_index(self, key: str) -> PathIndex: 
+        with timings.span('index.open') as s: 
+            index = PathIndex(self.cache_file(key, 'paths')).open()
+            s.add(items=len(index))
+        return index
 
-        self.touch_file(self.CACHE_PATH)
-        self.cache[key] = {
-            'date': datetime.date.today().strftime(self.DATEFMT),
-            'data': data
-        }
-        with open(self.CACHE_PATH, 'w') as f: 
-            json.dump(self.cache, f)
+    def build_path_index(self, key: str, paths: Iterable[str]) -> PathIndex: 
+        with timings.span('index.build') as s: 
+            index = PathIndex.build(self.cache_file(key, 'paths'), paths)
+            s.add(items=len(index))
+        self.save_cache(self.path_index_key(key), None)
+        return index
 
     def save_config(self) -> None:
         self.touch_file(self.CONFIG_PATH)
@@ -161,8 +400,15 @@ class DataManager(ABC):
 class CliClient(ABC): 
     DATA_MANAGER: DataManager
     
-    def __init__(self) -> None: 
-        self.data: DataManager = self.DATA_MANAGER()
+    def __init__(self, profile: Union[str, None] = None) -> None: 
+        self.data: DataManager = self.DATA_MANAGER(profile)
+        self.sampling = sampling.Options()
+        self.filters = filters.Filters()
+        # called once if this run serves expired items, to refresh them for the next one
+        self.refresher: Callable[['CliClient'], None] = spawn_refresh
+        self.revalidating = False
+        # cursors of seeded shuffles in this run, saved once it is over
+        self.cursors: Dict[str, sampling.Cursor] = {}
         
     def start(self, overwrite=False) -> None:
         self.data._freeze_config = False
@@ -190,12 +436,13 @@ class CliClient(ABC):
         else:
             user = self.data.config.user
 
+        keyring = self.data.keyring
         if (overwrite 
-            or (not self.data.use_keyring and self.data.config.password is None) 
-            or (self.data.use_keyring and keyring.get_password(self.data.SERVICE_NAME, user) is None) 
+            or (keyring is None and self.data.config.password is None) 
+            or (keyring is not None and keyring.get_password(self.data.SERVICE_NAME, user) is None) 
         ):
             password = getpass('Enter password: ')
-            if self.data.use_keyring:
+            if keyring is not None:
                 keyring.set_password(self.data.SERVICE_NAME,  user, password)
                 # fallback.
                 if keyring.get_password(self.data.SERVICE_NAME, user) != password: 
@@ -229,6 +476,75 @@ class CliClient(ABC):
         
         return parse.urlunsplit((scheme, netloc, path, query, fragment))
     
+    @abstractmethod
+    def make_path(self, key: str, artist: str, album: str, name: str) -> str: 
+        # MPD path of a cached item row under key
+        pass
+
+    @abstractmethod
+    def refresh(self, key: str) -> None: 
+        # bring the items cache for key up to date, if it has expired
+        pass
+
+    def cached(self, key: str) -> bool: 
+        # Whether cached items of key can be used for this run: ones downloaded recently, or (with background_refresh) 
+        # expired ones, which are then refreshed for the next run without this one waiting for it.
+        if self.data.has_items(key): 
+            return True
+        if not self.data.config.background_refresh or not self.data.is_cached(key): 
+            return False
+        logger.info('Using expired cache of {} while it is refreshed'.format(key))
+        self.data.stale.add(key)
+        if not self.revalidating: 
+            self.revalidating = True
+            self.refresher(self)
+        return True
+
+    def count(self, key: str) -> Union[int, None]: 
+        # number of items under key, if known without downloading them; used to weight sources against each other
+        return self.data.count_items(key) if self.data.has_items(key) else None
+
+    def sources(self) -> List['CliClient']: 
+        # the clients a run draws from, see fanout.MultiClient
+        return [self]
+
+    def save_cursors(self) -> None: 
+        # positions are taken once they have been pulled, including any pulled ahead of mpd (see --pipeline)
+        for key, cursor in self.cursors.items(): 
+            self.data.save_cursor(key, cursor.state())
+        self.cursors = {}
+
+    def get_path_index(self, key: str) -> Union[PathIndex, None]: 
+        # path index of a fully cached key, built from the cached items if needed
+        index = self.data.get_path_index(key)
+        if index is not None: 
+            return index
+        items = self.data.get_items(key)
+        if items is None: 
+            return None
+        return self.data.build_path_index(key, (self.make_path(key, *items[i]) for i in range(len(items))))
+
+    def shuf_index(self, key: str, index: PathIndex) -> Generator[str, None, None]: 
+        if self.sampling.is_seeded(): 
+            # Carry on through the permutation earlier runs took items from, computing each position as it is 
+            # needed, so a run takes time and memory for the items it adds, not for the whole library.
+            cursor = self.cursors[key] = sampling.Cursor.load(
+                self.data.get_cursor(key), len(index), self.data.config.library, self.sampling.seed
+            )
+            for i in cursor.order(): 
+                yield index[i]
+            return
+
+        with timings.span('shuffle', items=len(index)): 
+            if self.sampling.is_uniform(): 
+                order = list(range(len(index)))
+                random.shuffle(order)
+            else: 
+                # the path index is built from the cached items in order, so positions line up
+                order = sampling.order(self.data.get_items(key), self.sampling)
+        for i in order: 
+            yield index[i]
+
     @abstractmethod
     def _connect(self) -> None: 
         pass
@@ -248,3 +564,15 @@ class CliClient(ABC):
     @abstractmethod
     def shuf_all_songs(self) -> Generator[str, None, None]:
         pass 
+
+def spawn_refresh(client: CliClient) -> None: 
+    # a detached `jellyshuf --refresh-cache`, which outlives this run and takes the cache lock before writing
+    import subprocess
+    import sys
+    argv = [sys.executable, '-m', CONSTANTS.PROJECT_NAME, '--refresh-cache', client.data.spec]
+    logger.info('Refreshing cache in the background: {}'.format(' '.join(argv)))
+    try: 
+        subprocess.Popen(argv, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, 
+            start_new_session=True)
+    except OSError as e: 
+        logger.warning('Could not start background cache refresh: {}'.format(e))
@@ -0,0 +1,292 @@
+import hashlib
+import json
+import logging
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import time
+from array import array
+from pathlib import Path
+from typing import Iterable, List, Set, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+def tmp_tag() -> str:
+    # temporary files are per process and thread, as two runs, or a daemon's request and refresh, may write the same file at once
+    return '{}.{}'.format(os.getpid(), threading.get_ident())
+
+# (id, artist, album, name, genre, play_count, favorite); unused columns are None, e.g. album for albums
+ItemRow = Tuple[str, Union[str, None], Union[str, None], Union[str, None], Union[str, None], int, bool]
+
+class ItemTable:
+    # Cached items as int arrays indexing into a table of unique strings; 
+    # artist, album and genre names repeat a lot, particularly for songs
+    __slots__ = ('strings', 'artists', 'albums', 'names', 'genres', 'play_counts', 'favorites', '_index')
+
+    def __init__(self) -> None:
+        self.strings: List[str] = []
+        self.artists = array('I')
+        self.albums = array('I')
+        self.names = array('I')
+        self.genres = array('I')
+        self.play_counts = array('I')
+        self.favorites = array('B')
+        self._index = {}
+
+    def intern(self, s: Union[str, None]) -> int:
+        i = self._index.get(s)
+        if i is None:
+            i = self._index[s] = len(self.strings)
+            self.strings.append(s or '')
+        return i
+
+    def append(self, artist: Union[str, None], album: Union[str, None], name: Union[str, None], 
+            genre: Union[str, None] = None, play_count: int = 0, favorite: bool = False) -> None:
+        self.artists.append(self.intern(artist))
+        self.albums.append(self.intern(album))
+        self.names.append(self.intern(name))
+        self.genres.append(self.intern(genre))
+        self.play_counts.append(play_count or 0)
+        self.favorites.append(bool(favorite))
+
+    def freeze(self) -> 'ItemTable':
+        # the lookup dict is only needed while appending
+        self._index = None
+        return self
+
+    # Snapshot layout: header, then the strings NUL separated in one utf-8 blob, then each column as raw array bytes. 
+    # Loading is a few bulk reads and one split, instead of building the table row by row from the database.
+    MAGIC = b'JSIT'
+    VERSION = 1
+    HEADER = struct.Struct('<4sIQQQ') # magic, version, string count, item count, blob length
+    COLUMNS = ('artists', 'albums', 'names', 'genres', 'play_counts', 'favorites')
+
+    def dump(self, path: Path) -> None:
+        # written to a temporary file of this thread and renamed into place, so readers never see half a snapshot
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # MPD paths cannot contain NUL, so neither can anything that ends up in one
+        blob = '\0'.join(s.replace('\0', '') for s in self.strings).encode('utf-8')
+        tmp = path.with_suffix('{}.{}.tmp'.format(path.suffix, tmp_tag()))
+        with open(tmp, 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.VERSION, len(self.strings), len(self), len(blob)))
+            f.write(blob)
+            for column in self.COLUMNS:
+                getattr(self, column).tofile(f)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: Path) -> 'ItemTable':
+        # raises ValueError for a snapshot in another format, or one that is cut short
+        with open(path, 'rb') as f:
+            header = f.read(cls.HEADER.size)
+            if len(header) != cls.HEADER.size:
+                raise ValueError('Truncated item table {}'.format(path))
+            magic, version, n_strings, n_items, blob_len = cls.HEADER.unpack(header)
+            if magic != cls.MAGIC or version != cls.VERSION:
+                raise ValueError('Item table {} is not in version {} format'.format(path, cls.VERSION))
+
+            table = cls()
+            table.strings = f.read(blob_len).decode('utf-8').split('\0') if n_strings else []
+            if len(table.strings) != n_strings:
+                raise ValueError('Truncated item table {}'.format(path))
+            for column in cls.COLUMNS:
+                try:
+                    getattr(table, column).fromfile(f, n_items)
+                except EOFError as e:
+                    raise ValueError('Truncated item table {}'.format(path)) from e
+        return table.freeze()
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __getitem__(self, i: int) -> Tuple[str, str, str]:
+        # the columns making up the item's MPD path
+        return self.strings[self.artists[i]], self.strings[self.albums[i]], self.strings[self.names[i]]
+
+class PathIndex:
+    # Final MPD paths of a cached key, newline separated in one file, plus an array of their 
+    # start offsets (with a trailing end offset) in a second one. Looking up a path is a slice of the mmapped file.
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.offsets_path = path.with_suffix('.offsets')
+        self.offsets = array('Q')
+        self._mm = None
+
+    @classmethod
+    def build(cls, path: Path, paths: Iterable[str]) -> 'PathIndex':
+        path.parent.mkdir(parents=True, exist_ok=True)
+        offsets = array('Q', [0])
+        tmp = path.with_suffix('.paths.{}.tmp'.format(tmp_tag()))
+        with open(tmp, 'wb') as f:
+            for p in paths:
+                b = p.encode('utf-8') + b'\n'
+                f.write(b)
+                offsets.append(offsets[-1] + len(b))
+        offsets_tmp = path.with_suffix('.offsets.{}.tmp'.format(tmp_tag()))
+        with open(offsets_tmp, 'wb') as f:
+            offsets.tofile(f)
+        os.replace(offsets_tmp, path.with_suffix('.offsets'))
+        os.replace(tmp, path)
+        return cls(path).open()
+
+    def open(self) -> 'PathIndex':
+        offsets = array('Q')
+        with open(self.offsets_path, 'rb') as f:
+            offsets.frombytes(f.read())
+        self.offsets = offsets
+        with open(self.path, 'rb') as f:
+            # the two files are replaced one after the other, so they may be from different builds
+            if not offsets or offsets[-1] != os.fstat(f.fileno()).st_size:
+                raise ValueError('Path index {} does not match its offsets'.format(self.path))
+            if offsets[-1] > 0:
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self
+
+    def __len__(self) -> int:
+        return max(len(self.offsets) - 1, 0)
+
+    def __getitem__(self, i: int) -> str:
+        return self._mm[self.offsets[i]:self.offsets[i+1]-1].decode('utf-8')
+
+    def lines(self) -> List[str]:
+        # every path, decoded in one go; much faster than indexing them one by one
+        if self._mm is None:
+            return []
+        return self._mm[:].decode('utf-8').split('\n')[:-1]
+
+class Cache:
+    # bump when the tables below change; older caches are thrown away
+    SCHEMA_VERSION = 2
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY,
+            date TEXT NOT NULL,
+            data TEXT
+        );
+        CREATE TABLE IF NOT EXISTS items (
+            key TEXT NOT NULL,
+            id TEXT NOT NULL,
+            artist TEXT,
+            album TEXT,
+            name TEXT,
+            genre TEXT,
+            play_count INTEGER NOT NULL DEFAULT 0,
+            favorite INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (key, id)
+        );
+        CREATE TABLE IF NOT EXISTS history (
+            hash INTEGER PRIMARY KEY,
+            added REAL NOT NULL
+        );
+    '''
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._db = None
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        # only touch the disk once a key is actually requested
+        if self._db is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # the cache may be filled from a fetch thread in pipelined mode, one thread at a time
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            try:
+                version = self._db.execute('PRAGMA user_version').fetchone()[0]
+            except sqlite3.DatabaseError:
+                # start with a fresh cache on disk, as with a broken json config
+                logger.warning('Cache at {} is corrupt, starting with an empty one'.format(self.path))
+                self._db.close()
+                self.path.unlink()
+                self._db = sqlite3.connect(self.path, check_same_thread=False)
+                version = 0
+            if version != self.SCHEMA_VERSION:
+                self._db.executescript('DROP TABLE IF EXISTS entries; DROP TABLE IF EXISTS items; DROP TABLE IF EXISTS history;')
+                self._db.executescript(self.SCHEMA)
+                self._db.execute('PRAGMA user_version = {}'.format(self.SCHEMA_VERSION))
+        return self._db
+
+    def get_date(self, key: str) -> Union[str, None]:
+        row = self.db.execute('SELECT date FROM entries WHERE key = ?', (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def get_stamp(self, key: str) -> Union[Tuple[str, Union[str, None]], None]:
+        # changes whenever key is saved again with a new date or data
+        return self.db.execute('SELECT date, data FROM entries WHERE key = ?', (key,)).fetchone()
+
+    def get(self, key: str) -> Union[str, int, float, bool, None, dict, list]:
+        row = self.db.execute('SELECT data FROM entries WHERE key = ?', (key,)).fetchone()
+        return None if row is None or row[0] is None else json.loads(row[0])
+
+    def keys(self) -> List[str]:
+        return [row[0] for row in self.db.execute('SELECT key FROM entries')]
+
+    def set(self, key: str, date: str, data=None) -> None:
+        with self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO entries (key, date, data) VALUES (?, ?, ?)',
+                (key, date, None if data is None else json.dumps(data))
+            )
+
+    def delete(self, key: str) -> None:
+        with self.db:
+            self.db.execute('DELETE FROM entries WHERE key = ?', (key,))
+            self.db.execute('DELETE FROM items WHERE key = ?', (key,))
+
+    def replace_items(self, key: str, new: str, date: str, data=None) -> None:
+        # swap the items under new in for those under key, in one transaction so that readers see either
+        with self.db:
+            self.db.execute('DELETE FROM items WHERE key = ?', (key,))
+            self.db.execute('UPDATE items SET key = ? WHERE key = ?', (key, new))
+            self.db.execute('DELETE FROM entries WHERE key = ?', (new,))
+            self.db.execute(
+                'INSERT OR REPLACE INTO entries (key, date, data) VALUES (?, ?, ?)',
+                (key, date, None if data is None else json.dumps(data))
+            )
+
+    def get_items(self, key: str) -> ItemTable:
+        table = ItemTable()
+        # ordered, as positions in the table are used to index into the path index
+        for row in self.db.execute(
+            'SELECT artist, album, name, genre, play_count, favorite FROM items WHERE key = ? ORDER BY id', (key,)
+        ):
+            table.append(*row)
+        return table.freeze()
+
+    def count_items(self, key: str) -> int:
+        return self.db.execute('SELECT COUNT(*) FROM items WHERE key = ?', (key,)).fetchone()[0]
+
+    def add_items(self, key: str, rows: Iterable[ItemRow]) -> None:
+        with self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO items (key, id, artist, album, name, genre, play_count, favorite) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                ((key, *row) for row in rows)
+            )
+
+    @staticmethod
+    def path_hash(path: str) -> int:
+        return int.from_bytes(hashlib.blake2b(path.encode('utf-8'), digest_size=8).digest(), 'big', signed=True)
+
+    def get_history(self) -> Set[int]:
+        return {row[0] for row in self.db.execute('SELECT hash FROM history')}
+
+    def add_history(self, paths: Iterable[str], size: int) -> None:
+        # keep only the size most recently added paths
+        now = time.time()
+        with self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO history (hash, added) VALUES (?, ?)',
+                ((self.path_hash(path), now + i * 1e-6) for i, path in enumerate(paths))
+            )
+            self.db.execute(
+                'DELETE FROM history WHERE hash NOT IN (SELECT hash FROM history ORDER BY added DESC LIMIT ?)',
+                (size,)
+            )
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
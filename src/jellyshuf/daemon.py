@@ -0,0 +1,116 @@
+import contextlib
+import io
+import json
+import logging
+import os
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+from typing import Callable, List
+
+logger = logging.getLogger(__name__)
+
+# seconds between checks for expired caches of libraries the daemon has served
+REFRESH_INTERVAL = 3600
+# set to check before the interval is up, e.g. once a run has been served expired items
+WAKE = threading.Event()
+
+def refresh_now() -> None:
+    WAKE.set()
+
+def socket_path() -> str:
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    return os.path.join(runtime_dir, 'jellyshuf-{}.sock'.format(os.getuid()))
+
+class Handler(socketserver.StreamRequestHandler):
+    # One request per connection: a json line {"argv": [...]}. Output of the run is streamed back until the socket is closed.
+    def handle(self) -> None:
+        line = self.rfile.readline()
+        if not line:
+            return # liveness check, see request_available
+        try:
+            argv = json.loads(line)['argv']
+        except (ValueError, KeyError, TypeError):
+            self.wfile.write(b'Malformed request\n')
+            return
+
+        out = io.TextIOWrapper(self.wfile, encoding='utf-8', write_through=True)
+        try:
+            with self.server.lock, contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+                try:
+                    self.server.run(argv)
+                except SystemExit:
+                    pass # argparse errors and --help
+                except Exception as e:
+                    logger.exception('Request {} failed'.format(argv))
+                    print('Error: {}'.format(e))
+        finally:
+            out.detach()
+
+class Server(socketserver.UnixStreamServer):
+    def __init__(self, path: str, run: Callable[[List[str]], None]) -> None:
+        super().__init__(path, Handler)
+        self.run = run
+        # requests share the clients, so only one of them runs at a time; background refreshes download on 
+        # clients of their own and only take it to hand over to the shared ones
+        self.lock = threading.Lock()
+
+def serve(run: Callable[[List[str]], None], refresh: Callable[[], Callable[[], None]], interval: int) -> None:
+    # refresh brings the caches up to date alongside requests, and returns what to run between them once it is done
+    path = socket_path()
+    if os.path.exists(path):
+        if request_available(path):
+            print('{} is already in use by a running daemon'.format(path))
+            return
+        os.unlink(path)
+
+    server = Server(path, run)
+    os.chmod(path, 0o600)
+
+    def refresh_loop() -> None:
+        while True:
+            WAKE.wait(interval)
+            WAKE.clear()
+            try:
+                finish = refresh()
+                with server.lock:
+                    finish()
+            except Exception:
+                logger.exception('Background refresh failed')
+
+    threading.Thread(target=refresh_loop, name='jellyshuf-refresh', daemon=True).start()
+    print('Listening on {}'.format(path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+def request_available(path: str) -> bool:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(path)
+            return True
+        except OSError:
+            return False
+
+def request(argv: List[str]) -> bool:
+    # Run argv in the daemon, copying its output to stdout. Returns False if no daemon is listening.
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(socket_path())
+        except OSError:
+            return False
+        s.sendall(json.dumps({'argv': argv}).encode('utf-8') + b'\n')
+        s.shutdown(socket.SHUT_WR)
+        while True:
+            chunk = s.recv(65536)
+            if not chunk:
+                break
+            sys.stdout.buffer.write(chunk)
+            sys.stdout.flush()
+    return True
@@ -0,0 +1,198 @@
+import logging
+import queue
+import random
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Generator, Iterable, List, NamedTuple, Union
+
+from jellyshuf import base
+from jellyshuf.filters import Filters
+from jellyshuf.sampling import Options
+
+logger = logging.getLogger(__name__)
+
+# seconds a feed waits on a full queue before checking whether the run is over
+PUT_TIMEOUT = 0.1
+
+class Source(NamedTuple):
+    backend: str
+    profile: Union[str, None] = None
+    weight: Union[float, None] = None
+
+def parse_sources(spec: str) -> List[Source]:
+    # "jf,jf@work:2,ss": backends with an optional @profile and :weight, comma separated
+    sources = []
+    for part in spec.split(','):
+        part, _, weight = part.strip().partition(':')
+        backend, _, profile = part.partition('@')
+        sources.append(Source(backend, profile or None, float(weight) if weight else None))
+    return sources
+
+class Failed(NamedTuple):
+    error: Exception
+
+class Feed:
+    # One source's paths, pulled on a worker thread into a bounded queue, so that every source logs in, 
+    # counts and downloads at the same time while paths are drawn from all of them. Counting has a thread 
+    # of its own, so that it overlaps the first page of the shuffle instead of going before it.
+    DONE = object()
+
+    def __init__(self, client: base.CliClient, key: str, shuffle: Callable[[], Iterable[str]],
+            weight: Union[float, None], ready: Callable[[], None]) -> None:
+        self.client = client
+        self.ready = ready
+        self.weight = weight
+        self.size = None
+        self.counted = threading.Event()
+        self.stopped = threading.Event()
+        # a run never takes more than return_size from one source, so fetching further ahead is wasted
+        self.pending = queue.Queue(maxsize=max(min(client.data.config.pipeline_depth, client.return_size), 1))
+        threading.Thread(target=self.count, args=(key,), name='jellyshuf-count', daemon=True).start()
+        threading.Thread(target=self.fill, args=(shuffle,), name='jellyshuf-feed', daemon=True).start()
+
+    def count(self, key: str) -> None:
+        try:
+            self.ready()
+            self.size = self.client.count(key)
+        except Exception as e:
+            # weighted as an average source; if the server is down, the shuffle fails as well
+            logger.info('Could not count {} of {}: {}'.format(key, self.client.data.NAME, e))
+        finally:
+            self.counted.set()
+
+    def fill(self, shuffle: Callable[[], Iterable[str]]) -> None:
+        try:
+            self.ready()
+            for path in shuffle():
+                if not self.put(path):
+                    return
+        except Exception as e:
+            self.put(Failed(e))
+        finally:
+            self.put(self.DONE)
+
+    def put(self, item) -> bool:
+        # False once the run has stopped taking paths
+        while not self.stopped.is_set():
+            try:
+                self.pending.put(item, timeout=PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+def merge(feeds: List[Feed], rng: random.Random = random) -> Generator[str, None, None]:
+    # Draw each path from a source picked by its size, so that every item of the combined library is about as
+    # likely to come first, times its weight if one is given. Sources of unknown size count as average ones.
+    try:
+        for feed in feeds:
+            feed.counted.wait()
+        sizes = [feed.size for feed in feeds if feed.size is not None]
+        average = sum(sizes) / len(sizes) if sizes else 1
+        weights = [(feed.size if feed.size is not None else average) * (feed.weight if feed.weight is not None else 1)
+            for feed in feeds]
+
+        live = [i for i, w in enumerate(weights) if w > 0]
+        while live:
+            # a handful of sources, so a linear pick beats building an alias table for every draw
+            j = rng.choices(range(len(live)), weights=[weights[i] for i in live])[0]
+            item = feeds[live[j]].pending.get()
+            if item is Feed.DONE:
+                live.pop(j)
+            elif isinstance(item, Failed):
+                raise item.error
+            else:
+                yield item
+    finally:
+        for feed in feeds:
+            feed.stopped.set()
+
+class MultiClient:
+    # Stands in for a single client in run(), drawing from several. mpd settings and the history
+    # of recently added paths come from the first source's config.
+    def __init__(self, clients: List[base.CliClient], weights: List[Union[float, None]]) -> None:
+        self.clients = clients
+        self.weights = weights
+        self.data = clients[0].data
+        self.logins: List[Future] = []
+
+    @property
+    def return_size(self) -> int:
+        return self.clients[0].return_size
+
+    @return_size.setter
+    def return_size(self, size: int) -> None:
+        for client in self.clients:
+            client.return_size = size
+
+    @property
+    def sampling(self) -> Options:
+        return self.clients[0].sampling
+
+    @sampling.setter
+    def sampling(self, options: Options) -> None:
+        for client in self.clients:
+            client.sampling = options
+
+    @property
+    def filters(self) -> Filters:
+        return self.clients[0].filters
+
+    @filters.setter
+    def filters(self, filters: Filters) -> None:
+        for client in self.clients:
+            client.filters = filters
+
+    def sources(self) -> List[base.CliClient]:
+        return self.clients
+
+    def start(self, overwrite: bool = False) -> None:
+        # Prompts for missing config are asked one source at a time, then all sources log in at once. 
+        # Unless a library still has to be picked, start returns straight away and each source 
+        # starts its shuffle as soon as its own login is done, see shuf.
+        for client in self.clients:
+            if overwrite:
+                print('Configuring {}'.format(client.data.NAME))
+            client.data._freeze_config = False
+            client._pre_connect_cli(overwrite)
+
+        pick = overwrite or any(client.data.config.library is None for client in self.clients)
+        pool = ThreadPoolExecutor(max_workers=len(self.clients))
+        self.logins = [pool.submit(client._connect) if pick else pool.submit(self.connect, client) for client in self.clients]
+        pool.shutdown(wait=False)
+        if pick:
+            for client, login in zip(self.clients, self.logins):
+                login.result()
+                self.finish_start(client, overwrite)
+
+    def connect(self, client: base.CliClient) -> None:
+        client._connect()
+        self.finish_start(client)
+
+    @staticmethod
+    def finish_start(client: base.CliClient, overwrite: bool = False) -> None:
+        client._post_connect_cli(overwrite)
+        client.data._freeze_config = True
+        client.data.save_config()
+
+    def refresh(self, key: str) -> None:
+        for client in self.clients:
+            client.refresh(key)
+
+    def save_cursors(self) -> None:
+        for client in self.clients:
+            client.save_cursors()
+
+    def shuf(self, key: str, shuffle: Callable[[base.CliClient], Iterable[str]]) -> Generator[str, None, None]:
+        # sources are weighted by how many items match the filters, which are counted under the filtered key
+        return merge([Feed(client, client.filters.key(key), lambda c=client: shuffle(c), weight, login.result)
+            for client, weight, login in zip(self.clients, self.weights, self.logins)])
+
+    def shuf_all_albums(self) -> Generator[str, None, None]:
+        return self.shuf('albums', lambda client: client.shuf_all_albums())
+
+    def shuf_all_artists(self) -> Generator[str, None, None]:
+        return self.shuf('artists', lambda client: client.shuf_all_artists())
+
+    def shuf_all_songs(self) -> Generator[str, None, None]:
+        return self.shuf('songs', lambda client: client.shuf_all_songs())
@@ -0,0 +1,75 @@
+import hashlib
+from typing import NamedTuple, Tuple, Union
+from urllib import parse
+
+# the types filters apply to; artists are listed whole
+TYPES = ('albums', 'songs')
+
+def parse_years(s: str) -> Tuple[int, int]:
+    # "1994", "1990-1999" or the decade "1990s", as (first, last) year
+    s = s.strip()
+    if s.endswith('s'):
+        first = int(s[:-1])
+        return first, first + 9
+    first, sep, last = s.partition('-')
+    years = (int(first), int(last) if sep else int(first))
+    return min(years), max(years)
+
+def kind_of(key: str) -> str:
+    # "albums", "artists" or "songs", for a plain or filtered key (see Filters.key)
+    return key.partition('?')[0]
+
+def file_key(key: str) -> str:
+    # key as it goes into a cache file name: filter values can hold anything, so filtered keys go by a digest
+    kind, sep, query = key.partition('?')
+    if not sep:
+        return key
+    return '{}-{}'.format(kind, hashlib.blake2b(query.encode('utf-8'), digest_size=8).hexdigest())
+
+class Filters(NamedTuple):
+    genre: Union[str, None] = None
+    years: Union[Tuple[int, int], None] = None
+    favorites: bool = False
+    # stars out of 5
+    min_rating: Union[int, None] = None
+
+    def is_empty(self) -> bool:
+        return self.genre is None and self.years is None and not self.favorites and self.min_rating is None
+
+    def key(self, kind: str) -> str:
+        # Items under filters are cached apart from the whole library and from each other, under kind with the
+        # filters as a query string, e.g. "songs?genre=Rock&years=1990-1999"; item, path index, snapshot and
+        # cursor entries all derive from it.
+        if self.is_empty() or kind not in TYPES:
+            return kind
+        params = []
+        if self.favorites:
+            params.append(('favorites', '1'))
+        if self.genre is not None:
+            params.append(('genre', self.genre))
+        if self.min_rating is not None:
+            params.append(('min_rating', str(self.min_rating)))
+        if self.years is not None:
+            params.append(('years', '{}-{}'.format(*self.years)))
+        return '{}?{}'.format(kind, parse.urlencode(params))
+
+    @classmethod
+    def from_key(cls, key: str) -> 'Filters':
+        # the filters a key was made with, so that a refresh of it needs nothing but the key
+        params = dict(parse.parse_qsl(key.partition('?')[2]))
+        return cls(
+            params.get('genre'),
+            parse_years(params['years']) if 'years' in params else None,
+            params.get('favorites') == '1',
+            int(params['min_rating']) if 'min_rating' in params else None
+        )
+
+    def matches(self, genre: Union[str, None], year: Union[int, None], favorite: bool, rating: Union[int, None]) -> bool:
+        # for filters a server cannot apply itself; genre is matched whole, ignoring case
+        if self.genre is not None and (genre or '').casefold() != self.genre.casefold():
+            return False
+        if self.years is not None and (year is None or not self.years[0] <= year <= self.years[1]):
+            return False
+        if self.favorites and not favorite:
+            return False
+        return self.min_rating is None or (rating or 0) >= self.min_rating
@@ -1,10 +1,13 @@
+import datetime
 import logging
 import random
-from typing import Dict, Generator, List
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Generator, List, Tuple
 
 import requests
 
-from jellyshuf import base
+from jellyshuf import base, filters, session, timings
 
 """ This file contains modified source code from these files in mopidy-jellfin project:
         - mopidy-jellyfin/mopidy_jellyfin/remote.py 
@@ -15,6 +18,24 @@ from jellyshuf import base
 
 logger = logging.getLogger(__name__)
 
+# With a compiled ijson, large item responses are parsed as they download and only the projected rows are kept; 
+# otherwise (including ijson's pure python backend, which is far slower than json) responses are decoded whole.
+try: 
+    import ijson
+    if ijson.backend == 'python': 
+        ijson = None
+except ModuleNotFoundError: 
+    ijson = None
+
+# bytes handed to the parser at a time when parsing a response as it downloads
+STREAM_CHUNK_SIZE = 64 * 1024
+# Streaming costs several times the CPU of json per item, so it is only worth it for pages large enough 
+# that decoding them whole takes real memory; the default page_size stays below this.
+STREAM_MIN_ITEMS = 5000
+ITEM_FIELDS = ['Genres']
+# Start incremental syncs a little early to allow for clock skew; items seen twice are just rewritten
+SYNC_MARGIN = datetime.timedelta(minutes=10)
+
 class DataManager(base.DataManager):
     MPD_PREFIX = 'Jellyfin/Music'
     BACKEND_NAME = 'jellyfin'
@@ -22,8 +43,12 @@ class DataManager(base.DataManager):
 class CliClient(base.CliClient): 
     DATA_MANAGER = DataManager
     
+    def __init__(self, return_size=500, profile=None) -> None:
+        super().__init__(profile) 
+        self.return_size = return_size 
+    
     def _connect(self) -> None: 
-        self.session = requests.Session()
+        self.session = session.Session(self.data.config.max_connections, self.authenticate)
         self.session.headers.update({
             'user-agent': self.data.CLIENT_NAME, 
             'x-emby-authorization': 'MediaBrowser, Client="{}", Device="{}", DeviceId="{}", Version="{}"'.format(
@@ -34,17 +59,20 @@ class CliClient(base.CliClient):
             )
         })
         
-        self.user_id = None
-        token = self.data.get_cache('token')
-        
-        #try: 
-        res = 'None'
-        if token is not None: #attempt to connect on valid token
-            self.session.headers.update({'x-mediabrowser-token': token})
-            res = self.session.get(self.make_api_url('/User/Me'))
-            self.user_id= res.get('Id')
-        
-        if token is None or self.user_id is None:
+        # A login from an earlier run is used without checking it with the server while it is cached (a day, see 
+        # DataManager.get_cache); if the server has revoked the token since, the first request gets a 401 and logs in again.
+        login = self.data.get_cache(self.data.TOKEN_KEY)
+        if isinstance(login, dict) and login.get('url') == self.data.config.url and login.get('user') == self.data.config.user: 
+            self.user_id = login['user_id']
+            self.session.headers.update({'x-mediabrowser-token': login['token']})
+            logger.info('Reusing jellyfin login from an earlier run')
+        else: 
+            self.authenticate()
+
+    def authenticate(self) -> None: 
+        self.session.headers.pop('x-mediabrowser-token', None)
+        res = None
+        try: 
             res = self.session.post(
                 self.make_api_url('/Users/AuthenticateByName'),
                 json = {
@@ -52,120 +80,350 @@ class CliClient(base.CliClient):
                     'Pw': self.data.password
                 }
             )
-            print(self.session.headers) 
             res.raise_for_status()
-            res = res.json()
-            token = res.get('AccessToken')
-
-            if token is not None:
-                self.user_id = res.get('User').get('Id')
-                self.http.session.headers.update({'x-mediabrowser-token': token})
-                self.data.save_cache('token', token)
-            else:
-                raise base.BackendError('Token is None after trying /Users/AuthenticateByName.' + self.state_info(res))
+            rj = res.json()
+        except requests.RequestException as e: 
+            raise base.BackendError('Failed to login to jellyfin' + self.state_info(res)) from e
         
+        token = rj.get('AccessToken')
+        if token is None: 
+            raise base.BackendError('Token is None after trying /Users/AuthenticateByName.' + self.state_info(res))
+        self.user_id = rj.get('User').get('Id')
+        self.session.headers.update({'x-mediabrowser-token': token})
+        self.data.save_cache(self.data.TOKEN_KEY, {
+            'url': self.data.config.url, 
+            'user': self.data.config.user, 
+            'user_id': self.user_id, 
+            'token': token
+        })
         logger.info('Succesfully logged into jellyfin')
-        #except Exception as e: 
-        #    raise base.BackendError('Failed to login to jellyfin' + self.state_info(res)) from e
         
     def _post_connect_cli(self, overwrite) -> None: 
-        try: 
-            view = self.data.config.library
-            views = self.get_music_views()
-            if overwrite or view not in [e['Id'] for e in views]: 
-                raise KeyError 
-        except KeyError: 
-            print("Please select a library.")
-            for i, view in enumerate(views): 
-                print('    {}: {}'.format(i, view['Name']))
-            self.data.update_config(library=views[int(input("Enter library index: "))]['Id'])
+        # a configured library is trusted as is, so that runs need no request before fetching items
+        if not overwrite and self.data.config.library is not None: 
+            return
+        views = self.get_music_views()
+        print("Please select a library.")
+        for i, view in enumerate(views): 
+            print('    {}: {}'.format(i, view['Name']))
+        self.data.update_config(library=views[int(input("Enter library index: "))]['Id'])
 
     def get_music_views(self) -> List[Dict[str, str]]: 
-        res = self.session.post(self.make_api_url('/Users/{}/Views'.format(self.data.config_id)))
+        res = self.session.get(self.make_api_url('/Users/{}/Views'.format(self.user_id)))
+        res.raise_for_status()
         return [{'Name': library.get('Name'), 'Id': library.get('Id')}   
-            for library in res.get('Items')
+            for library in res.json().get('Items')
             if library.get('CollectionType') == 'music'
         ]
     
-    def shuf_all_albums(self) -> Generator[str, None, None]: 
-        albums = self.data.get_cache('albums')
+    @staticmethod
+    def item_params(params: Dict[str, str], limit: int) -> Dict[str, str]: 
+        # Jellyfin returns every optional field when Fields is omitted; only ask for the ones that are cached 
+        return {
+            **params,
+            'Fields': ','.join(ITEM_FIELDS),
+            'EnableImages': 'false',
+            'EnableUserData': 'true',
+            'Limit': str(limit)
+        }
+
+    def get_page(self, endpoint: str, params: Dict[str, str]) -> Tuple[List[base.ItemRow], int]: 
+        # projected items and TotalRecordCount of one request to an item endpoint
+        stream = ijson is not None and int(params['Limit']) >= STREAM_MIN_ITEMS
+        res = self.session.get(self.make_api_url(endpoint), params=params, stream=stream)
+        res.raise_for_status()
+        with timings.span('json') as s: 
+            if not stream: 
+                rj = res.json()
+                rows, total = [self.project(item) for item in rj['Items']], rj['TotalRecordCount']
+            else: 
+                rows, total = self.parse_page(res)
+            s.add(items=len(rows))
+        return rows, total
+
+    def parse_page(self, res: requests.Response) -> Tuple[List[base.ItemRow], int]: 
+        # Build one item at a time from parser events and project it straight away, 
+        # so neither the body nor the decoded items are ever held in full.
+        rows = []
+        total = None
+        builder = None
+        try: 
+            for prefix, event, value in self.parse_events(res): 
+                if builder is not None: 
+                    builder.event(event, value)
+                    if prefix == 'Items.item' and event == 'end_map': 
+                        rows.append(self.project(builder.value))
+                        builder = None
+                elif prefix == 'Items.item' and event == 'start_map': 
+                    builder = ijson.ObjectBuilder()
+                    builder.event(event, value)
+                elif prefix == 'TotalRecordCount': 
+                    total = value
+        except ijson.JSONError as e: 
+            raise ValueError('Malformed response from {}'.format(res.url)) from e
         
-        if albums is None: 
-            try: 
-                res = self.session.get(
-                    self.make_api_url( '/Items'),
-                    {            
-                        'UserId': self.data.config_id,
-                        'ParentId': self.data.config.library,
-                        'IncludeItemTypes': 'MusicAlbum',
-                        'Recursive': 'true'
-                    }
-                )
-                res.raise_for_status()
-                albums = res.json()['Items']
-                self.data.save_cache('albums', albums)
-            except Exception as e: 
-                raise base.Exception('Exception whilst trying to access albums on /Items' + self.state_info(res))
-
-        random.shuffle(albums)
-
-        for album in albums:
-            yield '{}/{}/{}'.format(
-                self.data.MPD_PREFIX, 
-                album['AlbumArtist'].translate(self.data.TRANSLATE_MPD_PATH),
-                album['Name'].translate(self.data.TRANSLATE_MPD_PATH)
-            )
+        if total is None: 
+            raise KeyError('TotalRecordCount')
+        return rows, total
 
-    def shuf_all_artists(self) -> Generator[str, None, None]: 
-        artists = self.data.get_cache('artists')
-
-        if artists is None:
-            try: 
-                res = self.http.get(
-                    self.make_api_url('/Artists/AlbumArtists'),
-                    {
-                        'ParentId': self.data.config.library,
-                        'UserId': self.data.config_id
-                    }
-                )
-                artists = res.json()['Items']
-                self.data.save_cache('artists', artists)
-            except Exception as e: 
-                raise base.BackendError('Exception whilst trying to access artists on /Artists/AlbumArtists' + self.state_info(res))
-
-        random.shuffle(artists)
-        for artist in artists: 
-            yield '{}/{}'.format(
-                self.data.MPD_PREFIX, 
-                artist['Name'].translate(self.data.TRANSLATE_MPD_PATH)
-            )
+    @staticmethod
+    def parse_events(res: requests.Response) -> Generator[Tuple[str, str, object], None, None]: 
+        # (prefix, event, value) parser events of a streamed response, as its chunks arrive
+        events = ijson.sendable_list()
+        parser = ijson.parse_coro(events, use_float=True)
+        for chunk in res.iter_content(STREAM_CHUNK_SIZE): 
+            parser.send(chunk)
+            yield from events
+            del events[:]
+        parser.close()
+        yield from events
 
-    def shuf_all_songs(self) -> Generator[str, None, None]: 
-        songs = self.data.get_cache('songs')
+    def get_pages(self, endpoint: str, params: Dict[str, str]) -> Generator[List[base.ItemRow], None, None]: 
+        # The first page gives the total; the rest are fetched up to max_connections at a time and 
+        # yielded in the order they arrive.
+        params = self.item_params(params, self.data.config.page_size)
         
-        if songs is None: 
-            try: 
-                res = self.http.get(
-                    self.make_api_url('/Items'), 
-                    {
-                        'UserId': self.data.config_id,
-                        'ParentId': self.data.config.library,
-                        'IncludeItemTypes': 'Audio',
-                        'Recursive': 'true'
-                    }
-                )
-                songs = res.json()['Items']
-                self.data.save_cache('songs', songs) 
-            except Exception as e:
-                raise base.BackendError('Exception whilst trying to access songs on /Items' + self.state_info(res))
+        try: 
+            first_page, total = self.get_page(endpoint, {**params, 'StartIndex': '0'})
+            yield first_page
             
-        random.shuffle(songs) 
+            starts = range(self.data.config.page_size, total, self.data.config.page_size)
+            with ThreadPoolExecutor(max_workers=max(self.data.config.max_connections, 1)) as pool: 
+                futures = [pool.submit(self.get_page, endpoint, {**params, 'StartIndex': str(start)}) for start in starts]
+                for future in as_completed(futures): 
+                    yield future.result()[0]
+        except (requests.RequestException, ValueError, KeyError) as e: 
+            raise base.BackendError('Exception whilst trying to access {}'.format(endpoint) + self.state_info()) from e
+
+    def sample_items(self, endpoint: str, params: Dict[str, str]) -> Generator[base.ItemRow, None, None]: 
+        # Let the server pick random items, about return_size at a time; repeats across requests are dropped
+        params = self.item_params(
+            {**params, 'SortBy': 'Random'}, 
+            min(max(self.return_size, 1), self.data.config.page_size)
+        )
+        seen = set()
 
-        for song in songs: 
-            yield '{}/{}/{}/{}'.format(
+        try: 
+            while True: 
+                rows, total = self.get_page(endpoint, params)
+                
+                new = [row for row in rows if row[0] not in seen]
+                if not new: 
+                    return
+                for row in new: 
+                    seen.add(row[0])
+                    yield row
+                
+                if len(seen) >= total: 
+                    return
+        except (requests.RequestException, ValueError, KeyError) as e: 
+            raise base.BackendError('Exception whilst trying to sample {}'.format(endpoint) + self.state_info()) from e
+
+    @staticmethod
+    def project(item: base.JSONDict) -> base.ItemRow: 
+        user_data = item.get('UserData') or {}
+        genres = item.get('Genres') or [None]
+        return (
+            item['Id'], 
+            item.get('AlbumArtist') or '', 
+            item.get('Album') or '', 
+            item.get('Name') or '',
+            genres[0],
+            user_data.get('PlayCount') or 0,
+            bool(user_data.get('IsFavorite'))
+        )
+
+    @staticmethod
+    def sync_marker() -> str: 
+        return (datetime.datetime.now(datetime.timezone.utc) - SYNC_MARGIN).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    def sync_items(self, key: str, endpoint: str, params: Dict[str, str], since: str) -> bool: 
+        # Fetch only items saved since the last sync. Jellyfin does not report deletions, so if 
+        # the cached count no longer matches the server's afterwards, give up and let the caller refetch everything.
+        synced = self.sync_marker()
+        for rows in self.get_pages(endpoint, {**params, 'MinDateLastSaved': since}): 
+            self.data.add_items(key, rows)
+        
+        if self.count_items(endpoint, params) != self.data.count_items(key): 
+            # the cached items stay in use until the refetch replaces them
+            logger.info('Item count for {} changed beyond new items, refetching all'.format(key))
+            return False
+        
+        self.data.finish_items(key, synced)
+        return True
+
+    def count_items(self, endpoint: str, params: Dict[str, str]) -> int: 
+        res = None
+        try: 
+            res = self.session.get(self.make_api_url(endpoint), params=self.item_params(params, 1))
+            res.raise_for_status()
+            return res.json()['TotalRecordCount']
+        except requests.RequestException as e: 
+            raise base.BackendError('Exception whilst trying to count {}'.format(endpoint) + self.state_info(res)) from e
+
+    def make_path(self, key: str, artist: str, album: str, name: str) -> str: 
+        key = filters.kind_of(key)
+        if key == 'artists': 
+            return '{}/{}'.format(
                 self.data.MPD_PREFIX, 
-                song['AlbumArtist'].translate(self.data.TRANSLATE_MPD_PATH),
-                song['Album'].translate(self.data.TRANSLATE_MPD_PATH),
-                song['Name'].translate(self.data.TRANSLATE_MPD_PATH)
+                name.translate(self.data.TRANSLATE_MPD_PATH)
             )
+        if key == 'albums': 
+            return '{}/{}/{}'.format(
+                self.data.MPD_PREFIX, 
+                artist.translate(self.data.TRANSLATE_MPD_PATH),
+                name.translate(self.data.TRANSLATE_MPD_PATH)
+            )
+        return '{}/{}/{}/{}'.format(
+            self.data.MPD_PREFIX, 
+            artist.translate(self.data.TRANSLATE_MPD_PATH),
+            album.translate(self.data.TRANSLATE_MPD_PATH),
+            name.translate(self.data.TRANSLATE_MPD_PATH)
+        )
+
+    def fetch_items(self, key: str, endpoint: str, params: Dict[str, str], sync: bool = True) -> Generator[List[base.ItemRow], None, None]: 
+        # Download every item under key page by page, writing each page to the cache as it comes in, 
+        # unless another run is writing this cache already
+        with self.data.lock() as locked: 
+            if not locked: 
+                logger.info('Cache of {} is being written by another run, not caching {}'.format(self.data.NAME, key))
+                yield from self.get_pages(endpoint, params)
+                return
+            written = self.data.write_key(key)
+            self.data.clear_items(written)
+            synced = self.sync_marker()
+            for rows in self.get_pages(endpoint, params): 
+                self.data.add_items(written, rows)
+                yield rows
+            self.data.finish_items(key, synced if sync else None, written)
+
+    def item_query(self, key: str) -> Tuple[str, Dict[str, str], bool]: 
+        # endpoint and params listing every item under key, and whether the endpoint takes MinDateLastSaved
+        kind = filters.kind_of(key)
+        if kind == 'artists': 
+            return '/Artists/AlbumArtists', {
+                'ParentId': self.data.config.library,
+                'UserId': self.user_id
+            }, False
+        return '/Items', {
+            'UserId': self.user_id,
+            'ParentId': self.data.config.library,
+            'IncludeItemTypes': 'MusicAlbum' if kind == 'albums' else 'Audio',
+            'Recursive': 'true',
+            **self.filter_params(filters.Filters.from_key(key))
+        }, True
+
+    @staticmethod
+    def filter_params(f: filters.Filters) -> Dict[str, str]: 
+        # Filters the server applies itself, so that a filtered run downloads (and counts) only matching items. 
+        # Jellyfin keeps no star ratings per user; min_rating goes by community rating, which is out of 10.
+        params = {}
+        if f.genre is not None: 
+            params['Genres'] = f.genre
+        if f.years is not None: 
+            params['Years'] = ','.join(str(year) for year in range(f.years[0], f.years[1] + 1))
+        if f.favorites: 
+            params['IsFavorite'] = 'true'
+        if f.min_rating is not None: 
+            params['MinCommunityRating'] = str(f.min_rating * 2)
+        return params
+
+    def count(self, key: str) -> int: 
+        cached = super().count(key)
+        if cached is not None: 
+            return cached
+        endpoint, params, _ = self.item_query(key)
+        return self.count_items(endpoint, params)
+
+    def try_sync(self, key: str, endpoint: str, params: Dict[str, str], sync: bool) -> None: 
+        if not self.data.has_items(key) and sync: 
+            since = self.data.get_synced(key)
+            if since is not None: 
+                with self.data.lock() as locked: 
+                    if locked: 
+                        self.sync_items(key, endpoint, params, since)
+
+    def refresh(self, key: str) -> None: 
+        self.data.stale.discard(key)
+        endpoint, params, sync = self.item_query(key)
+        self.try_sync(key, endpoint, params, sync)
+        if not self.data.has_items(key): 
+            for _ in self.fetch_items(key, endpoint, params, sync): 
+                pass
+
+    def shuf_paths(self, key: str) -> Generator[str, None, None]: 
+        endpoint, params, sync = self.item_query(key)
+        if not self.cached(key): 
+            self.try_sync(key, endpoint, params, sync)
 
+            if (not self.data.has_items(key) and self.data.config.cache 
+                    and (not self.sampling.is_uniform() or self.sampling.is_seeded())): 
+                # weighted, stratified and seeded draws work on the whole cached library
+                self.refresh(key)
+
+        index = self.get_path_index(key)
+        if index is not None: 
+            yield from self.shuf_index(key, index)
+            return 
+        
+        if self.return_size <= self.data.config.sample_size: 
+            for row in self.sample_items(endpoint, params): 
+                yield self.make_path(key, *row[1:4])
+            return
+
+        if not self.data.config.cache: 
+            # Pages come in server order (by artist), so with nowhere to put them every item is in hand before 
+            # the first is drawn
+            rows = [row for page in self.fetch_items(key, endpoint, params, sync) for row in page]
+            random.shuffle(rows)
+            for row in rows: 
+                yield self.make_path(key, *row[1:4])
+            return
+
+        # Draw from the server's random pages while every item is downloaded to the cache on a thread of its own, 
+        # then shuffle the cached items for the rest, skipping the paths drawn already. The download carries on 
+        # if the run ends first, so that the next run finds the cache filled.
+        done = threading.Event()
+        threading.Thread(target=self.cache_items, args=(key, endpoint, params, sync, done), name='jellyshuf-cache').start()
+        samples = self.sample_items(endpoint, params)
+        taken = set()
+        index = None
+        for row in samples: 
+            path = self.make_path(key, *row[1:4])
+            taken.add(path)
+            yield path
+            if done.is_set(): 
+                index = self.get_path_index(key)
+                break
+        else: 
+            return
+
+        if index is None: 
+            # not cached after all: the download failed, or another run was writing the cache
+            for row in samples: 
+                yield self.make_path(key, *row[1:4])
+            return
+        with timings.span('shuffle', items=len(index)): 
+            order = list(range(len(index)))
+            random.shuffle(order)
+        for i in order: 
+            if index[i] not in taken: 
+                yield index[i]
+
+    def cache_items(self, key: str, endpoint: str, params: Dict[str, str], sync: bool, done: threading.Event) -> None: 
+        try: 
+            for _ in self.fetch_items(key, endpoint, params, sync): 
+                pass
+        except base.BackendError as e: 
+            logger.info('Could not cache {}: {}'.format(key, e))
+        finally: 
+            done.set()
+
+    def shuf_all_albums(self) -> Generator[str, None, None]: 
+        return self.shuf_paths(self.filters.key('albums'))
+
+    def shuf_all_artists(self) -> Generator[str, None, None]: 
+        return self.shuf_paths('artists')
+
+    def shuf_all_songs(self) -> Generator[str, None, None]: 
+        return self.shuf_paths(self.filters.key('songs'))
@@ -0,0 +1,209 @@
+import logging
+import os
+import queue
+import re
+import socket
+import threading
+from itertools import islice
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Generator, Iterable, List, Set, Union
+
+from jellyshuf import timings
+
+# musicpd is imported where mpd is talked to, so that --stdout runs, which only filter paths here, never load it
+if TYPE_CHECKING:
+    import musicpd
+
+logger = logging.getLogger(__name__)
+
+# MPD acks a failed command list with "[error@index] {command} message"; index is of the failed command
+ACK_INDEX = re.compile(r'^\[\d+@(\d+)\]')
+
+def no_delay(mpd: 'musicpd.MPDClient') -> None:
+    # MPD only answers a command list once it ends, so with Nagle's algorithm the last adds of every batch
+    # wait for MPD's delayed ack (some 40ms) before they are sent. Send each command straight away instead.
+    with socket.socket(fileno=os.dup(mpd.fileno())) as s:
+        if s.family in (socket.AF_INET, socket.AF_INET6):
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+def queued_paths(mpd: 'musicpd.MPDClient') -> Set[str]:
+    # every file in the queue and every directory above one, so album and artist paths match as well
+    queued = set()
+    for song in mpd.playlistinfo():
+        path = song['file']
+        while path and path not in queued:
+            queued.add(path)
+            path = path.rpartition('/')[0]
+    return queued
+
+def skip_seen(paths: Iterable[str], queued: Set[str], history: Set[int], 
+        path_hash: Callable[[str], int]) -> Generator[str, None, None]:
+    # drop paths that are queued or were added recently (or offered earlier in this run)
+    for path in paths:
+        if path in queued:
+            logger.info('Skipping {}, already in queue'.format(path))
+            continue
+        h = path_hash(path)
+        if h in history:
+            logger.info('Skipping {}, added recently'.format(path))
+            continue
+        history.add(h)
+        yield path
+
+def send(mpd: 'musicpd.MPDClient', path: str, playlist: Union[str, None]) -> None:
+    # to the queue, or to the end of stored playlist playlist
+    if playlist is None:
+        mpd.add(path)
+    else:
+        mpd.playlistadd(playlist, path)
+
+def announce(paths: List[str], playlist: Union[str, None], added: Union[List[str], None]) -> None:
+    # Called with the paths mpd has taken. Those are appended to added, for the history of recently added paths;
+    # ones that failed (or were declined, see run) never are. Playlists are for large batches, which are summed
+    # up once they are loaded instead.
+    if added is not None:
+        added.extend(paths)
+    if playlist is None:
+        for path in paths:
+            print('Added {}'.format(path))
+
+def add(mpd: 'musicpd.MPDClient', path: str, playlist: Union[str, None] = None, 
+        added: Union[List[str], None] = None) -> bool:
+    import musicpd
+    try:
+        with timings.span('mpd.add', items=1):
+            send(mpd, path, playlist)
+        announce([path], playlist, added)
+        return True
+    except musicpd.CommandError as e:
+        print('Failed to add {}'.format(path))
+        print(str(e))
+        return False
+
+def add_batch(mpd: 'musicpd.MPDClient', paths: List[str], playlist: Union[str, None] = None, 
+        added: Union[List[str], None] = None) -> int:
+    # Add paths in one command list and return how many were added. MPD stops at the first failing add;
+    # the adds before it have gone through, the rest of the batch is retried one at a time.
+    import musicpd
+    try:
+        with timings.span('mpd.add_batch', items=len(paths)):
+            mpd.command_list_ok_begin()
+            for path in paths:
+                send(mpd, path, playlist)
+            mpd.command_list_end()
+    except musicpd.CommandError as e:
+        m = ACK_INDEX.match(str(e))
+        if m is None:
+            logger.warning('Could not tell which add failed in command list, retrying all of it: {}'.format(e))
+            return sum(add(mpd, path, playlist, added) for path in paths)
+
+        failed = int(m.group(1))
+        announce(paths[:failed], playlist, added)
+        print('Failed to add {}'.format(paths[failed]))
+        print(str(e))
+        return failed + sum(add(mpd, path, playlist, added) for path in paths[failed+1:])
+
+    announce(paths, playlist, added)
+    return len(paths)
+
+def add_all(mpd: 'musicpd.MPDClient', paths: Iterable[str], batch_size: int, playlist: Union[str, None] = None, 
+        added: Union[List[str], None] = None) -> int:
+    # returns how many paths were tried, whether or not they could be added
+    if batch_size <= 1:
+        tried = 0
+        for path in paths:
+            add(mpd, path, playlist, added)
+            tried += 1
+        return tried
+
+    paths = iter(paths)
+    tried = 0
+    while True:
+        batch = list(islice(paths, batch_size))
+        if not batch:
+            return tried
+        add_batch(mpd, batch, playlist, added)
+        tried += len(batch)
+
+def add_pipelined(mpd: 'musicpd.MPDClient', paths: Iterable[str], batch_size: int, depth: int, 
+        on_first_batch: Union[Callable[[], None], None] = None, playlist: Union[str, None] = None, 
+        added: Union[List[str], None] = None) -> int:
+    # Pull paths (and so backend pages) on a worker thread while adding to mpd on this one. 
+    # The bounded queue stops the worker from getting more than depth paths ahead of mpd.
+    pending = queue.Queue(maxsize=max(depth, 1))
+    done = object()
+    errors = []
+
+    def produce() -> None:
+        try:
+            for path in paths:
+                pending.put(path)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            pending.put(done)
+
+    threading.Thread(target=produce, name='jellyshuf-fetch', daemon=True).start()
+
+    tried = 0
+    finished = False
+    while not finished:
+        # block for one path, then take whatever else is ready up to a full batch
+        batch = [pending.get()]
+        while len(batch) < batch_size:
+            try:
+                batch.append(pending.get_nowait())
+            except queue.Empty:
+                break
+        if batch[-1] is done:
+            batch.pop()
+            finished = True
+        if not batch:
+            continue
+
+        if len(batch) == 1:
+            add(mpd, batch[0], playlist, added)
+        else:
+            add_batch(mpd, batch, playlist, added)
+        if tried == 0 and on_first_batch is not None:
+            on_first_batch()
+        tried += len(batch)
+
+    if errors:
+        raise errors[0]
+    return tried
+
+def write_m3u(path: Path, paths: Iterable[str], added: Union[List[str], None] = None) -> int:
+    # Stream paths to an m3u file, one per line, and return how many were written. Written to a temporary
+    # file of this process and renamed into place, so mpd never loads half a playlist.
+    tmp = path.with_name('.{}.{}.tmp'.format(path.name, os.getpid()))
+    written = 0
+    with open(tmp, 'w', encoding='utf-8') as f:
+        for p in paths:
+            f.write(p)
+            f.write('\n')
+            written += 1
+            if added is not None:
+                added.append(p)
+    os.replace(tmp, path)
+    return written
+
+def save_playlist(mpd: 'musicpd.MPDClient', name: str, paths: Iterable[str], batch_size: int, 
+        directory: Union[str, None] = None, depth: Union[int, None] = None, added: Union[List[str], None] = None) -> int:
+    # Replace stored playlist name with paths, to load into the queue in one go, and return how many paths were
+    # tried. Written straight to name.m3u if mpd's playlist directory is known (and reachable from here), else
+    # sent in command lists of playlistadd, pipelined like adds if depth is given.
+    if directory is not None:
+        with timings.span('playlist.write') as s:
+            tried = write_m3u(Path(directory).expanduser().joinpath(name + '.m3u'), paths, added)
+            s.add(items=tried)
+        return tried
+
+    import musicpd
+    try:
+        mpd.rm(name)
+    except musicpd.CommandError:
+        pass # no such playlist yet
+    if depth is not None:
+        return add_pipelined(mpd, paths, batch_size, depth, playlist=name, added=added)
+    return add_all(mpd, paths, batch_size, playlist=name, added=added)
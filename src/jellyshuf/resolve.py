@@ -0,0 +1,278 @@
+import bisect
+import logging
+import unicodedata
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Generator, Iterable, List, Sequence, Set, Tuple, Union
+
+import musicpd
+
+from jellyshuf import base, player, timings
+from jellyshuf.cache import PathIndex
+
+logger = logging.getLogger(__name__)
+
+# articles some taggers move to the end of a name, e.g. "Beatles, The"
+ARTICLES = ('the', 'a', 'an')
+# A lookup bisects the listing, some 20 reads of the mmapped file. Once a run has made more lookups than 
+# 1/BISECT_SHARE of the listing, e.g. for a large playlist, all of it is decoded into a dict instead.
+BISECT_SHARE = 32
+
+def fold(name: str) -> str:
+    # Compare path components by their letters and digits only: case, accents, punctuation (e.g. a '/' dropped
+    # by TRANSLATE_MPD_PATH or replaced on disk) and "Name, The" against "The Name" vary between what servers
+    # send and the names mpd or mopidy list
+    s = unicodedata.normalize('NFKD', name.casefold())
+    head, sep, tail = s.rpartition(',')
+    if sep and tail.strip() in ARTICLES:
+        s = tail + head
+    return ''.join(c for c in s if c.isalnum())
+
+def fold_path(relative: str) -> str:
+    return '/'.join(fold(part) for part in relative.split('/'))
+
+def name_of(entry: str) -> str:
+    return entry.partition('\0')[0]
+
+def target_of(entry: str) -> str:
+    name, _, uri = entry.partition('\0')
+    return uri or name
+
+def walk(mpd: musicpd.MPDClient, directory: str) -> List[str]:
+    # Entries below directory, one command list of lsinfo per level. Tracks that are listed by uri rather
+    # than by a path below their directory (mopidy) are entered as "directory/title\0uri", see Resolver.
+    entries = []
+    level = [directory]
+    while level:
+        mpd.command_list_ok_begin()
+        for d in level:
+            mpd.lsinfo(d)
+        results = mpd.command_list_end()
+        next_level = []
+        for d, listing in zip(level, results):
+            for entry in listing:
+                if 'directory' in entry:
+                    entries.append(entry['directory'])
+                    next_level.append(entry['directory'])
+                elif 'file' in entry:
+                    uri = entry['file']
+                    if uri.startswith(d + '/'):
+                        entries.append(uri)
+                    else:
+                        title = entry.get('title', uri.rpartition('/')[2])
+                        entries.append('{}/{}\0{}'.format(d, title.replace('/', ''), uri))
+        level = next_level
+    return entries
+
+def list_tree(mpd: musicpd.MPDClient, directory: str) -> List[str]:
+    # Every directory and file below directory: one listall on mpd. mopidy lists tracks by uri, without
+    # the titles a backend path ends in, so there (or where listall is refused) the tree is walked instead.
+    try:
+        entries = [path for entry in mpd.listall(directory) for kind, path in entry.items() if kind in ('directory', 'file')]
+        if all(path.startswith(directory + '/') for path in entries):
+            return entries
+    except musicpd.CommandError as e:
+        logger.info('listall {} failed, walking it instead: {}'.format(directory, e))
+    return walk(mpd, directory)
+
+class Resolver:
+    # What mpd lists under one MPD_PREFIX, sorted: paths, or "path\0uri" for tracks added by uri. A backend path
+    # is added as the listed entry that has that path, else that matches it once folded (see fold), else, if
+    # nothing is listed under its artist at all, that matches all of it but the artist. The last one finds albums
+    # and songs that mopidy-jellyfin lists under another artist than the album artist, as with albumartistsort off;
+    # where the artist is listed, an album of the same name under another artist is more likely a different album.
+    # Folded lookups are only built on a miss.
+    def __init__(self, prefix: str, entries: Sequence[str], mpd: Union[musicpd.MPDClient, None] = None) -> None:
+        self.prefix = prefix
+        self.entries = entries
+        self.mpd = mpd
+        self.extra: Dict[str, str] = {}
+        self.lookups = 0
+        self.exact: Union[Dict[str, str], None] = None
+        self.folded: Union[Dict[str, Union[str, None]], None] = None
+        self.moved: Union[Dict[str, Union[str, None]], None] = None
+        self.artists: Set[str] = set()
+        self.listed: Set[str] = set()
+
+    def __len__(self) -> int:
+        return len(self.entries) + len(self.extra)
+
+    def find(self, path: str) -> Union[str, None]:
+        if self.exact is None:
+            self.lookups += 1
+            if self.lookups * BISECT_SHARE > len(self.entries):
+                with timings.span('resolve.decode', items=len(self.entries)):
+                    self.exact = {name_of(entry): target_of(entry) for entry in self.all_entries()}
+            else:
+                i = bisect.bisect_left(self.entries, path)
+                if i < len(self.entries) and name_of(self.entries[i]) == path:
+                    return target_of(self.entries[i])
+                return self.extra.get(path)
+        return self.exact.get(path) or self.extra.get(path)
+
+    def all_entries(self) -> List[str]:
+        return self.entries.lines() if isinstance(self.entries, PathIndex) else self.entries
+
+    def build_folded(self) -> None:
+        with timings.span('resolve.fold', items=len(self)):
+            self.folded, self.moved = {}, {}
+            for entry in self.all_entries():
+                self.add_folded(entry)
+            for name, target in self.extra.items():
+                self.add_folded(name + '\0' + target)
+
+    def add_folded(self, entry: str) -> None:
+        # names that fold alike but are listed apart are ambiguous (None) and never matched
+        name = name_of(entry)
+        target = target_of(entry)
+        key = fold_path(name[len(self.prefix)+1:])
+        self.folded[key] = target if self.folded.get(key, target) == target else None
+        artist, _, rest = key.partition('/')
+        self.artists.add(artist)
+        if rest:
+            self.moved[rest] = target if self.moved.get(rest, target) == target else None
+
+    def lookup(self, path: str) -> Union[str, None]:
+        target = self.find(path)
+        if target is not None:
+            return target
+        if self.folded is None:
+            self.build_folded()
+        key = fold_path(path[len(self.prefix)+1:])
+        target = self.folded.get(key)
+        artist, _, rest = key.partition('/')
+        if target is None and artist not in self.artists:
+            target = self.moved.get(rest)
+        return target
+
+    def resolve(self, path: str) -> Union[str, None]:
+        target = self.lookup(path)
+        if target is not None or self.mpd is None:
+            return target
+        # Not listed, maybe because it was added to mpd since the listing was cached: list its artist again,
+        # once per run, and look once more.
+        top = '/'.join(path.split('/', self.prefix.count('/') + 2)[:self.prefix.count('/') + 2])
+        if top in self.listed:
+            return None
+        self.listed.add(top)
+        try:
+            with timings.span('mpd.relist') as s:
+                entries = list_tree(self.mpd, top)
+                s.add(items=len(entries))
+        except musicpd.CommandError:
+            return None # no such directory
+        for entry in [top] + entries:
+            name = name_of(entry)
+            if self.find(name) is None:
+                self.extra[name] = target_of(entry)
+                if self.folded is not None:
+                    self.add_folded(entry)
+        return self.lookup(path)
+
+def index_path(data: base.DataManager, prefix: str):
+    return data.CACHE_DIR.joinpath('{}_mpd_{}.paths'.format(data.NAME, prefix.replace('/', '_')))
+
+def load(data: base.DataManager, mpd: musicpd.MPDClient, prefix: str) -> Resolver:
+    # The listing of prefix is cached along with mpd's db_update, and only listed again once mpd's database has
+    # been updated (or the cache has expired). Then only the artist directories whose last-modified changed are
+    # listed again; servers that give no last-modified (mopidy) are listed in full.
+    key = 'mpd:{}'.format(prefix)
+    path = index_path(data, prefix)
+    server = '{}:{}'.format(data.config.mpd_host, data.config.mpd_port)
+    db_update = mpd.stats().get('db_update')
+
+    old = None
+    cached = data.get_cache(key)
+    if isinstance(cached, dict) and cached.get('server') == server:
+        try:
+            old = PathIndex(path).open()
+        except (OSError, ValueError):
+            old = None
+    if old is not None and cached.get('db_update') == db_update:
+        return Resolver(prefix, old, mpd)
+
+    with timings.span('mpd.list') as s:
+        dirs: Dict[str, Union[str, None]] = {}
+        entries: Set[str] = set()
+        for entry in mpd.lsinfo(prefix):
+            if 'directory' in entry:
+                d = entry['directory']
+                modified = dirs[d] = entry.get('last-modified')
+                entries.add(d)
+                if old is not None and modified is not None and cached['dirs'].get(d) == modified:
+                    # entries below d are the ones from d + '/' up to, but not including, d + '0'
+                    entries.update(old[i] for i in range(bisect.bisect_left(old, d + '/'), bisect.bisect_left(old, d + '0')))
+                else:
+                    entries.update(list_tree(mpd, d))
+            elif 'file' in entry:
+                entries.add(entry['file'])
+        entries = sorted(entries)
+        s.add(items=len(entries))
+
+    if not data.config.cache:
+        return Resolver(prefix, entries, mpd)
+    with timings.span('index.build', items=len(entries)):
+        index = PathIndex.build(path, entries)
+    data.save_cache(key, {'server': server, 'db_update': db_update, 'dirs': dirs})
+    return Resolver(prefix, index, mpd)
+
+def load_all(data: base.DataManager, prefixes: Iterable[str]) -> Tuple[Union[musicpd.MPDClient, None], List[Resolver]]:
+    # on a connection of its own, as paths are resolved on whichever thread pulls them (see player.add_pipelined)
+    mpd = musicpd.MPDClient()
+    try:
+        with timings.span('mpd.index') as s:
+            mpd.connect(data.config.mpd_host, data.config.mpd_port)
+            player.no_delay(mpd)
+            resolvers = []
+            for prefix in prefixes:
+                resolver = load(data, mpd, prefix)
+                if len(resolver) == 0:
+                    logger.warning('mpd lists nothing under {}, adding its paths unchecked'.format(prefix))
+                else:
+                    resolvers.append(resolver)
+                s.add(items=len(resolver))
+        return mpd, resolvers
+    except (musicpd.MPDError, OSError) as e:
+        logger.warning('Could not list the mpd database, adding paths unchecked: {}'.format(e))
+        close(mpd)
+        return None, []
+
+def start(data: base.DataManager, prefixes: Iterable[str]) -> Future:
+    # list (or load) the mpd database while the backend fetches its first items
+    pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='jellyshuf-resolve')
+    loading = pool.submit(load_all, data, sorted(set(prefixes)))
+    pool.shutdown(wait=False)
+    return loading
+
+def resolve_all(paths: Iterable[str], loading: Future) -> Generator[str, None, None]:
+    # paths as mpd lists them; paths mpd does not list are dropped, so that every add goes through
+    resolvers = None
+    for path in paths:
+        if resolvers is None:
+            resolvers = loading.result()[1]
+        resolver = next((r for r in resolvers if path.startswith(r.prefix + '/')), None)
+        if resolver is None:
+            yield path
+            continue
+        target = resolver.resolve(path)
+        if target is None:
+            logger.info('Skipping {}, not in mpd database'.format(path))
+        elif target != path:
+            logger.info('Resolved {} to {}'.format(path, target))
+            yield target
+        else:
+            yield path
+
+def close(mpd: Union[musicpd.MPDClient, None]) -> None:
+    if mpd is None:
+        return
+    try:
+        mpd.disconnect()
+    except (musicpd.MPDError, OSError):
+        pass
+
+def finish(loading: Future) -> None:
+    # the listing connection is only needed while paths are being resolved
+    if loading.done():
+        close(loading.result()[0])
+    else:
+        loading.add_done_callback(lambda f: close(f.result()[0]))
@@ -0,0 +1,205 @@
+import logging
+import random
+from array import array
+from typing import Dict, Generator, List, NamedTuple, Sequence, Union
+
+from jellyshuf.cache import ItemTable
+
+logger = logging.getLogger(__name__)
+
+WEIGHTS = ('playcount', 'favorites')
+# how much more likely a favourite is to be drawn than anything else with --weight favorites
+FAVORITE_WEIGHT = 10
+# rebuild a group's alias table over the undrawn items after this many draws in a row hit drawn ones
+MAX_REJECTIONS = 16
+# rounds of the Feistel network in Permutation; 4 make a good enough shuffle for picking music
+FEISTEL_ROUNDS = 4
+
+class Options(NamedTuple):
+    weight: Union[str, None] = None
+    per_artist: Union[int, None] = None
+    per_album: Union[int, None] = None
+    by_genre: bool = False
+    resume: bool = False
+    seed: Union[int, None] = None
+
+    def is_uniform(self) -> bool:
+        return self.weight is None and self.per_artist is None and self.per_album is None and not self.by_genre
+
+    def is_seeded(self) -> bool:
+        # uniform draws that follow a permutation kept between runs, see Cursor
+        return self.resume or self.seed is not None
+
+class AliasTable:
+    # Vose's alias method: O(n) to build, O(1) per weighted draw
+    def __init__(self, weights: Sequence[float]) -> None:
+        n = len(weights)
+        total = sum(weights)
+        self.prob = array('d', (w * n / total for w in weights))
+        self.alias = array('I', bytes(4 * n))
+
+        small = [i for i, p in enumerate(self.prob) if p < 1]
+        large = [i for i, p in enumerate(self.prob) if p >= 1]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.alias[s] = l
+            self.prob[l] = self.prob[l] + self.prob[s] - 1
+            (small if self.prob[l] < 1 else large).append(l)
+        for i in small + large:
+            self.prob[i] = 1
+
+    def __len__(self) -> int:
+        return len(self.prob)
+
+    def draw(self, rng: random.Random) -> int:
+        i = rng.randrange(len(self.prob))
+        return i if rng.random() < self.prob[i] else self.alias[i]
+
+class UniformGroup:
+    def __init__(self, indices: List[int]) -> None:
+        self.indices = indices
+
+    def draw(self, rng: random.Random) -> Union[int, None]:
+        # swap a random undrawn index to the end and pop it
+        if not self.indices:
+            return None
+        j = rng.randrange(len(self.indices))
+        self.indices[j], self.indices[-1] = self.indices[-1], self.indices[j]
+        return self.indices.pop()
+
+class WeightedGroup:
+    # draws without replacement by rejecting repeats, which is cheap while most of the group is undrawn
+    def __init__(self, indices: List[int], weights: Sequence[float]) -> None:
+        self.weights = weights
+        self.drawn = set()
+        self.build(indices)
+
+    def build(self, indices: List[int]) -> None:
+        self.pool = indices
+        self.table = AliasTable([self.weights[i] for i in indices]) if indices else None
+
+    def draw(self, rng: random.Random) -> Union[int, None]:
+        while self.table is not None:
+            for _ in range(MAX_REJECTIONS):
+                i = self.pool[self.table.draw(rng)]
+                if i not in self.drawn:
+                    self.drawn.add(i)
+                    return i
+            self.build([i for i in self.pool if i not in self.drawn])
+        return None
+
+def weights(items: ItemTable, weight: Union[str, None]) -> Union[Sequence[float], None]:
+    if weight == 'playcount':
+        return array('d', (1 + c for c in items.play_counts))
+    if weight == 'favorites':
+        return array('d', (FAVORITE_WEIGHT if f else 1 for f in items.favorites))
+    return None
+
+def order(items: ItemTable, options: Options, rng: random.Random = random) -> Generator[int, None, None]:
+    # Yield positions in items in random order, as set by options. With by_genre a genre is picked uniformly
+    # for every draw, then an item within it; per_artist and per_album drop items past the cap.
+    w = weights(items, options.weight)
+
+    if options.by_genre:
+        buckets: Dict[int, List[int]] = {}
+        for i, genre in enumerate(items.genres):
+            buckets.setdefault(genre, []).append(i)
+        groups = list(buckets.values())
+    else:
+        groups = [list(range(len(items)))]
+    groups = [UniformGroup(g) if w is None else WeightedGroup(g, w) for g in groups]
+
+    artist_counts: Dict[int, int] = {}
+    album_counts: Dict[tuple, int] = {}
+    while groups:
+        g = rng.randrange(len(groups))
+        i = groups[g].draw(rng)
+        if i is None:
+            groups[g] = groups[-1]
+            groups.pop()
+            continue
+
+        if options.per_artist is not None:
+            artist = items.artists[i]
+            if artist_counts.get(artist, 0) >= options.per_artist:
+                continue
+            artist_counts[artist] = artist_counts.get(artist, 0) + 1
+        if options.per_album is not None:
+            album = (items.artists[i], items.albums[i])
+            if album_counts.get(album, 0) >= options.per_album:
+                continue
+            album_counts[album] = album_counts.get(album, 0) + 1
+        yield i
+
+class Permutation:
+    # A random permutation of range(count) that is never stored: position i maps through a Feistel network
+    # keyed by seed over the smallest even number of bits that covers count, and values of count or more
+    # are fed through again (cycle walking). The domain is less than 4 * count, so that takes under 4 rounds
+    # on average. The same seed and count always give the same order.
+    def __init__(self, count: int, seed: int) -> None:
+        self.count = count
+        bits = max((count - 1).bit_length(), 2)
+        self.half = (bits + 1) // 2
+        self.mask = (1 << self.half) - 1
+        rng = random.Random(seed)
+        self.keys = [rng.getrandbits(32) for _ in range(FEISTEL_ROUNDS)]
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, i: int) -> int:
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        half, mask = self.half, self.mask
+        while True:
+            left, right = i >> half, i & mask
+            for key in self.keys:
+                # round function: the finaliser of murmur3 over the right half and the round key
+                x = ((right ^ key) * 0x85EBCA6B) & 0xFFFFFFFF
+                x = ((x ^ (x >> 13)) * 0xC2B2AE35) & 0xFFFFFFFF
+                left, right = right, left ^ ((x ^ (x >> 16)) & mask)
+            i = (left << half) | right
+            if i < self.count:
+                return i
+
+class Cursor:
+    # Where runs have got to in the seeded permutation of a cached key. Once every position has been taken,
+    # the next run starts a new permutation; so does one whose library or item count changed.
+    def __init__(self, count: int, library, seed: Union[int, None] = None, position: int = 0) -> None:
+        self.count = count
+        self.library = library
+        self.seed = random.getrandbits(63) if seed is None else seed
+        self.position = position
+
+    @classmethod
+    def load(cls, state: Union[dict, None], count: int, library, seed: Union[int, None] = None) -> 'Cursor':
+        # a given seed starts its permutation from the beginning, so that its order can be repeated
+        if seed is not None:
+            return cls(count, library, seed)
+        if isinstance(state, dict) and state.get('count') == count and state.get('library') == library:
+            return cls(count, library, state['seed'], state['position'])
+        return cls(count, library)
+
+    def state(self) -> dict:
+        return {'count': self.count, 'library': self.library, 'seed': self.seed, 'position': self.position}
+
+    def order(self) -> Generator[int, None, None]:
+        # positions in items, each at most once per run; position moves on with every one taken. Items taken
+        # this run before a wrap are skipped in the new order, which is still at the start when the run ends.
+        permutation = Permutation(self.count, self.seed)
+        start = self.position
+        taken = set()
+        yielded = 0
+        while yielded < self.count:
+            if self.position >= self.count:
+                logger.info('Went through all {} items, starting a new order'.format(self.count))
+                taken = {permutation[p] for p in range(start, self.count)}
+                self.seed = random.getrandbits(63)
+                self.position = 0
+                permutation = Permutation(self.count, self.seed)
+            i = permutation[self.position]
+            self.position += 1
+            if i in taken:
+                continue
+            yielded += 1
+            yield i
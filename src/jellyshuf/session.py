@@ -0,0 +1,35 @@
+import logging
+from typing import Callable, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from jellyshuf import timings
+
+logger = logging.getLogger(__name__)
+
+class Session(requests.Session):
+    # One keep-alive session per client. Connections are pooled, up to max_connections at once for parallel page fetches,
+    # and responses come compressed (gzip, plus br with the brotli package installed, as requests asks for by default).
+    # A request rejected with 401, e.g. because credentials cached by an earlier run were revoked, is sent once more
+    # after calling reauthenticate, which should update the session's headers.
+    def __init__(self, max_connections: int, reauthenticate: Union[Callable[[], None], None] = None) -> None:
+        super().__init__()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(max_connections, 1))
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+        self.hooks['response'].append(timings.record_response)
+        self.reauthenticate = reauthenticate
+
+    def request(self, method, url, *args, **kwargs) -> requests.Response:
+        res = super().request(method, url, *args, **kwargs)
+        if res.status_code == 401 and self.reauthenticate is not None:
+            logger.info('{} {} was unauthorized, logging in again'.format(method, url))
+            # no retries for requests made while logging in
+            reauthenticate, self.reauthenticate = self.reauthenticate, None
+            try:
+                reauthenticate()
+            finally:
+                self.reauthenticate = reauthenticate
+            res = super().request(method, url, *args, **kwargs)
+        return res
@@ -1,13 +1,20 @@
-from typing import Generator, Union
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Generator, List, Tuple, Union
 import logging
 import hashlib
+import random
 import secrets
 import requests
 
-from jellyshuf import base
+from jellyshuf import base, filters, session, timings
 
 logger = logging.getLogger(__name__)
 
+# most servers cap size on getAlbumList/getRandomSongs at this
+MAX_PAGE_SIZE = 500
+# error codes for a login the server does not accept: wrong username or password, token auth unsupported, bad api key
+AUTH_ERRORS = (40, 41, 44)
+
 class DataManager(base.DataManager):
     MPD_PREFIX = "Subsonic/Directories"
     BACKEND_NAME = "Subsonic"
@@ -15,45 +22,60 @@ class DataManager(base.DataManager):
 class CliClient(base.CliClient): 
     DATA_MANAGER = DataManager 
     
-    def __init__(self, return_size=500) -> None:
-        super().__init__() 
+    def __init__(self, return_size=500, profile=None) -> None:
+        super().__init__(profile) 
         self.return_size = return_size 
     
     def _connect(self) -> None:
-        self.session = requests.Session()
-        salt = secrets.token_hex()
+        self.session = session.Session(self.data.config.max_connections)
         
-        self.params = {
+        # The salted token is worked out locally, so a login from an earlier run saves the ping checking it. 
+        # If the server stops accepting it, the first request fails with an auth error and logs in again (see get_response).
+        login = self.data.get_cache(self.data.TOKEN_KEY)
+        if isinstance(login, dict) and login.get('url') == self.data.config.url and login.get('user') == self.data.config.user: 
+            self.params = self.auth_params(login['salt'], login['token'])
+            logger.info("Reusing subsonic login from an earlier run")
+        else: 
+            self.authenticate()
+
+    def auth_params(self, salt: str, token: str) -> Dict[str, str]: 
+        return {
             'f': 'json',
             'v': base.CONSTANTS.SUBSONIC_API_VERSION,
             'u': self.data.config.user,
             'c': self.data.CLIENT_NAME,
             's': salt,
-            't': hashlib.md5((self.data.password+salt).encode('utf-8')).hexdigest()
+            't': token
         }
+
+    def authenticate(self) -> None: 
+        salt = secrets.token_hex()
+        token = hashlib.md5((self.data.password+salt).encode('utf-8')).hexdigest()
+        self.params = self.auth_params(salt, token)
+        self.get_response('/rest/ping', self.params, retry=False)
+        self.data.save_cache(self.data.TOKEN_KEY, {
+            'url': self.data.config.url, 
+            'user': self.data.config.user, 
+            'salt': salt, 
+            'token': token
+        })
+        logger.info("Succesfully authenticated to subsonic server")
         
+    def state_info(self, response: Union[requests.Response, None]) -> str: 
+        # error responses need not come from a subsonic server at all, e.g. a 404 page or a proxy's error page
+        if response is None: 
+            return super().state_info() + '\n            Base URL: {}\n'.format(self.data.config.url)
         try: 
-            r = self.session.get(
-                self.make_api_url('/rest/ping'),
-                params=self.params
-            )
-            r.raise_for_status()
-            rj = r.json()['subsonic-response']
-        except Exception as e: 
-            raise base.BackendError("Error authenticating to *sonic server:\n" + self.state_info(r))
-        
-        if rj['status'] != 'ok': 
-            raise base.BackendError("Non-ok status in Subsonic API response when authenticating:\n" + self.state_info(r))
-        else: 
-            logger.info("Succesfully authenticated to subsonic server")
-        
-        
-    def state_info(self, response:requests.Response) -> str: 
-        rj = response.json()['subsonic-response']
+            rj = response.json()['subsonic-response']
+        except (ValueError, KeyError, TypeError): 
+            rj = None
+        if not isinstance(rj, dict): 
+            rj = {}
         return super().state_info() + """
             Base URL: {}
 
             Details of the last response:
+            HTTP Status: {}
             Subsonic Status: {}
             Error: {} 
             Server Type: {}
@@ -62,6 +84,7 @@ class CliClient(base.CliClient):
             Request URL: {}
         """.format(
             self.data.config.url,
+            response.status_code,
             rj.get('status'),
             rj.get('error'),
             rj.get('type'),
@@ -71,6 +94,10 @@ class CliClient(base.CliClient):
         )
     
     def _post_connect_cli(self, overwrite) -> None:
+        # a configured folder is trusted as is, so that runs need no request before fetching items
+        if not overwrite and self.data.config.library is not None: 
+            return
+        r = None
         try:
             r = self.session.get(
                 self.make_api_url('/rest/getMusicFolders'),
@@ -88,48 +115,227 @@ class CliClient(base.CliClient):
             folder_i = int(input("Enter folder number: "))-1
             self.data.update_config(library=libraries[folder_i]['id'])
     
+    def get_response(self, endpoint: str, params: Dict[str, str], retry: bool = True) -> base.JSONDict: 
+        res = None
+        try: 
+            res = self.session.get(self.make_api_url(endpoint), params=params)
+            if retry and res.status_code == 401: 
+                return self.reauthenticated(endpoint, params)
+            res.raise_for_status()
+            with timings.span('json'): 
+                rj = res.json()['subsonic-response']
+        except (requests.RequestException, ValueError, KeyError) as e: 
+            raise base.BackendError("Error when trying to access {} backend".format(endpoint) 
+                + ('' if res is None else self.state_info(res))) from e
+        
+        if rj['status'] != 'ok': 
+            if retry and (rj.get('error') or {}).get('code') in AUTH_ERRORS: 
+                return self.reauthenticated(endpoint, params)
+            raise base.BackendError("Non-ok status in Subsonic API response from {}:\n".format(endpoint) + self.state_info(res))
+        return rj
+
+    def reauthenticated(self, endpoint: str, params: Dict[str, str]) -> base.JSONDict: 
+        # the server no longer accepts the login, e.g. one cached from before a password change; log in again and retry once
+        logger.info("Subsonic server rejected login for {}, logging in again".format(endpoint))
+        self.authenticate()
+        return self.get_response(endpoint, {**params, **self.params}, retry=False)
+
+    def get_random_page(self, endpoint: str, params: Dict[str, str], list_key: str, item_key: str) -> List[base.JSONDict]: 
+        return self.get_response(endpoint, params).get(list_key, {}).get(item_key, [])
+
+    def get_list(self, endpoint: str, params: Dict[str, str], list_key: str, item_key: str) -> Generator[base.JSONDict, None, None]: 
+        # a list the server returns in a fixed order, paged through MAX_PAGE_SIZE at a time
+        offset = 0
+        while True: 
+            page = self.get_random_page(endpoint, {**params, 'size': str(MAX_PAGE_SIZE), 'offset': str(offset)}, list_key, item_key)
+            yield from page
+            if len(page) < MAX_PAGE_SIZE: 
+                return
+            offset += len(page)
+
+    def get_random(self, endpoint: str, params: Dict[str, str], list_key: str, item_key: str) -> Generator[base.JSONDict, None, None]: 
+        # Servers cap the size of random lists, so ask for return_size in parallel pages of at most MAX_PAGE_SIZE 
+        # and keep going with fresh random pages, dropping repeats, for as long as the caller takes items (some may 
+        # be skipped, e.g. as recently added) or until nothing new comes back.
+        seen = set()
+        remaining = self.return_size
+        workers = max(self.data.config.max_connections, 1)
+        with ThreadPoolExecutor(max_workers=workers) as pool: 
+            while True: 
+                # after the first round ask for full pages, as later rounds mostly return items that have been seen already
+                pages = min(-(-max(remaining, 1) // MAX_PAGE_SIZE), workers)
+                size = MAX_PAGE_SIZE if seen else min(max(remaining, 1), MAX_PAGE_SIZE)
+                futures = [
+                    pool.submit(self.get_random_page, endpoint, {**params, 'size': str(size)}, list_key, item_key) 
+                    for _ in range(pages)
+                ]
+
+                new = 0
+                for future in as_completed(futures): 
+                    for item in future.result(): 
+                        if item['id'] in seen: 
+                            continue
+                        seen.add(item['id'])
+                        new += 1
+                        remaining -= 1
+                        yield item
+                if new == 0: 
+                    return
+
     def shuf_all_albums(self) -> Generator[str, None, None]:
-        url = self.make_api_url('/rest/getAlbumList')
+        key = self.filters.key('albums')
+        if key != 'albums': 
+            yield from self.shuf_cached(key)
+            return
+
         params = {   
             **self.params, 
             'type': 'random',
-            'size': str(self.return_size), 
             'musicFolderId': str(self.data.config.library)
         }
         
-        try: 
-            res = self.session.get(url, params=params)
-            res.raise_for_status()
-            albums = res.json()['subsonic-response']['albumList']['album']
-        except Exception as e: 
-            raise base.BackendError("Error when trying to access getAlbumList backend" + self.state_info()) from e
-        
-        for album in albums: 
+        for album in self.get_random('/rest/getAlbumList', params, 'albumList', 'album'): 
             yield '{}/{}/{}'.format(
                 self.data.MPD_PREFIX,
                 album['artist'].translate(self.data.TRANSLATE_MPD_PATH),
                 album['title'].translate(self.data.TRANSLATE_MPD_PATH)
             )
             
-    def shuf_all_artists(self): 
-        raise NotImplementedError
+    def make_path(self, key: str, artist: str, album: str, name: str) -> str: 
+        kind = filters.kind_of(key)
+        if kind == 'albums': 
+            return '{}/{}/{}'.format(
+                self.data.MPD_PREFIX,
+                artist.translate(self.data.TRANSLATE_MPD_PATH),
+                name.translate(self.data.TRANSLATE_MPD_PATH)
+            )
+        if kind == 'songs': 
+            # song rows hold the path the server gives, see sync_filtered
+            return '{}/{}'.format(self.data.MPD_PREFIX, name)
+        return '{}/{}'.format(
+            self.data.MPD_PREFIX,
+            name.translate(self.data.TRANSLATE_MPD_PATH)
+        )
+
+    def sync_artists(self) -> List[base.ItemRow]: 
+        # getIndexes returns the whole index, or none of it if nothing changed since ifModifiedSince
+        key = 'artists'
+        params = {
+            **self.params,
+            'musicFolderId': str(self.data.config.library)
+        }
+        since = self.data.get_synced(key)
+        if since is not None: 
+            params['ifModifiedSince'] = since
+        
+        indexes = self.get_response('/rest/getIndexes', params)['indexes']
+        if since is not None and not indexes.get('index'): 
+            logger.info('Artist index unchanged since last sync')
+            self.data.save_cache(key, since)
+            return []
+
+        rows = [(artist['id'], None, None, artist['name'], None, 0, 'starred' in artist) 
+            for index in indexes.get('index', []) 
+            for artist in index.get('artist', [])
+        ]
+        with self.data.lock() as locked: 
+            if locked: 
+                written = self.data.write_key(key)
+                self.data.clear_items(written)
+                self.data.add_items(written, rows)
+                self.data.finish_items(key, indexes.get('lastModified'), written)
+        return rows
+
+    @staticmethod
+    def album_list_params(f: filters.Filters) -> Tuple[Dict[str, str], filters.Filters]: 
+        # getAlbumList applies one filter at a time: its params, and the filters left to apply to what it returns
+        if f.genre is not None: 
+            return {'type': 'byGenre', 'genre': f.genre}, f._replace(genre=None)
+        if f.years is not None: 
+            return {'type': 'byYear', 'fromYear': str(f.years[0]), 'toYear': str(f.years[1])}, f._replace(years=None)
+        if f.favorites: 
+            return {'type': 'starred'}, f._replace(favorites=False)
+        return {'type': 'alphabeticalByName'}, f
+
+    def sync_filtered(self, key: str) -> List[base.ItemRow]: 
+        # Every album, or starred song, matching the filters of key. Unlike random lists, these are paged 
+        # through in order, so they are downloaded whole and cached under key, like the artist index.
+        f = filters.Filters.from_key(key)
+        params = {
+            **self.params,
+            'musicFolderId': str(self.data.config.library)
+        }
+        if filters.kind_of(key) == 'albums': 
+            list_params, f = self.album_list_params(f)
+            items = self.get_list('/rest/getAlbumList', {**params, **list_params}, 'albumList', 'album')
+            name = 'title'
+        else: 
+            items = self.get_response('/rest/getStarred', params).get('starred', {}).get('song', [])
+            f = f._replace(favorites=False)
+            name = 'path'
+        rows = [(item['id'], item.get('artist'), item.get('album'), item[name], item.get('genre'), item.get('playCount', 0), 'starred' in item) 
+            for item in items 
+            if f.matches(item.get('genre'), item.get('year'), 'starred' in item, item.get('userRating'))
+        ]
+        with self.data.lock() as locked: 
+            if locked: 
+                written = self.data.write_key(key)
+                self.data.clear_items(written)
+                self.data.add_items(written, rows)
+                self.data.finish_items(key, None, written)
+        return rows
+
+    def sync(self, key: str) -> List[base.ItemRow]: 
+        return self.sync_artists() if key == 'artists' else self.sync_filtered(key)
+
+    def count(self, key: str) -> Union[int, None]: 
+        cached = super().count(key)
+        if cached is not None or key != 'songs': 
+            return cached
+        # most servers count songs in getScanStatus; there is no cheap count of albums
+        return self.get_response('/rest/getScanStatus', self.params).get('scanStatus', {}).get('count')
+
+    def refresh(self, key: str) -> None: 
+        # albums and songs are picked by the server and not cached, unless filtered (see sync_filtered)
+        self.data.stale.discard(key)
+        if key not in ('albums', 'songs') and not self.data.has_items(key): 
+            self.sync(key)
+
+    def shuf_cached(self, key: str) -> Generator[str, None, None]: 
+        if not self.cached(key): 
+            rows = self.sync(key)
+            if not self.data.has_items(key): 
+                random.shuffle(rows)
+                for row in rows: 
+                    yield self.make_path(key, *row[1:4])
+                return
+
+        index = self.get_path_index(key)
+        if index is not None: 
+            yield from self.shuf_index(key, index)
+
+    def shuf_all_artists(self) -> Generator[str, None, None]: 
+        return self.shuf_cached('artists')
     
     def shuf_all_songs(self): 
-        url = self.make_api_url('/rest/getRandomSongs')
+        # getRandomSongs filters by genre and years itself, but not by starred, which getStarred lists instead
+        if self.filters.favorites: 
+            yield from self.shuf_cached(self.filters.key('songs'))
+            return
+
         params = {   
             **self.params,
-            'size': str(self.return_size),
             'musicFolderId': str(self.data.config.library)
         }       
-        try:
-            res = self.session.get(url, params=params)
-            res.raise_for_status()
-            songs = res.json()['subsonic-response']['randomSongs']['song']
-        except Exception as e:  
-            raise base.BackendError("Error when trying to access getAlbumList backend" + self.state_info()) from e
+        if self.filters.genre is not None: 
+            params['genre'] = self.filters.genre
+        if self.filters.years is not None: 
+            params['fromYear'], params['toYear'] = (str(year) for year in self.filters.years)
         
-        for song in songs: 
+        for song in self.get_random('/rest/getRandomSongs', params, 'randomSongs', 'song'): 
+            if self.filters.min_rating is not None and song.get('userRating', 0) < self.filters.min_rating: 
+                continue
             yield '{}/{}'.format(
                 self.data.MPD_PREFIX,
                 song['path']
-            )
\ No newline at end of file
+            )
@@ -0,0 +1,112 @@
+import json
+import os
+import threading
+import time
+from typing import Dict, List
+from urllib.parse import urlsplit
+
+class Span:
+    __slots__ = ('name', 'counts', 'thread', 'start', 'end')
+
+    def __init__(self, name: str, counts: Dict[str, int]) -> None:
+        self.name = name
+        self.counts = counts
+        self.thread = threading.get_ident()
+        self.start = self.end = 0.0
+
+    def add(self, **counts: int) -> None:
+        for k, v in counts.items():
+            self.counts[k] = self.counts.get(k, 0) + v
+
+    def __enter__(self) -> 'Span':
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.end = time.perf_counter()
+        RECORDER.spans.append(self) # list.append is atomic, spans come from fetch and mpd threads alike
+
+class NullSpan:
+    # handed out while timings are off, so instrumented code costs a function call and nothing else
+    def add(self, **counts: int) -> None:
+        pass
+
+    def __enter__(self) -> 'NullSpan':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        pass
+NULL_SPAN = NullSpan()
+
+class Recorder:
+    def __init__(self) -> None:
+        self.enabled = False
+        self.started = 0.0
+        self.spans: List[Span] = []
+
+    def enable(self) -> None:
+        self.enabled = True
+        self.started = time.perf_counter()
+        self.spans = []
+
+    def disable(self) -> None:
+        self.enabled = False
+RECORDER = Recorder()
+
+def enable() -> None:
+    # start recording spans, dropping any from earlier runs
+    RECORDER.enable()
+
+def disable() -> None:
+    RECORDER.disable()
+
+def span(name: str, **counts: int):
+    # time a stage: `with span('cache.write', items=len(rows)) as s: ...`; counts can also be added with s.add()
+    return Span(name, counts) if RECORDER.enabled else NULL_SPAN
+
+def record_response(res, *args, **kwargs) -> None:
+    # requests response hook: one span per request, from sending it until its body has been read. 
+    # Streamed bodies are left to the caller to read (and time), counting the bytes the server says it sends.
+    if not RECORDER.enabled:
+        return
+    if kwargs.get('stream'):
+        size = int(res.headers.get('Content-Length', 0))
+    else:
+        size = len(res.content)
+    s = Span('http {}'.format(urlsplit(res.url).path), {'bytes': size})
+    s.end = time.perf_counter()
+    s.start = s.end - res.elapsed.total_seconds()
+    RECORDER.spans.append(s)
+
+def summary() -> str:
+    totals: Dict[str, Dict[str, float]] = {}
+    for s in RECORDER.spans:
+        t = totals.setdefault(s.name, {'calls': 0, 'ms': 0.0, 'items': 0, 'bytes': 0})
+        t['calls'] += 1
+        t['ms'] += (s.end - s.start) * 1000
+        for k in ('items', 'bytes'):
+            t[k] += s.counts.get(k, 0)
+
+    # stages nest and overlap across threads, so totals can add up to more than the wall time
+    lines = ['{:<28} {:>6} {:>10} {:>9} {:>11}'.format('stage', 'calls', 'total ms', 'items', 'bytes')]
+    for name, t in sorted(totals.items(), key=lambda kv: -kv[1]['ms']):
+        lines.append('{:<28} {:>6} {:>10.1f} {:>9} {:>11}'.format(
+            name, t['calls'], t['ms'], t['items'] or '', t['bytes'] or ''
+        ))
+    lines.append('{:<28} {:>6} {:>10.1f}'.format('wall', '', (time.perf_counter() - RECORDER.started) * 1000))
+    return '\n'.join(lines)
+
+def write_trace(path: str) -> None:
+    # Chrome trace event format, which chrome://tracing and Perfetto open; it is plain json otherwise
+    pid = os.getpid()
+    events = [{
+        'name': s.name,
+        'ph': 'X',
+        'ts': round((s.start - RECORDER.started) * 1e6),
+        'dur': round((s.end - s.start) * 1e6),
+        'pid': pid,
+        'tid': s.thread,
+        'args': s.counts
+    } for s in RECORDER.spans]
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
@@ -0,0 +1,56 @@
+from types import SimpleNamespace
+from typing import List, Union
+
+from jellyshuf.fanout import MultiClient
+
+class Data:
+    NAME = 'stub'
+
+    def __init__(self, library: Union[str, None]) -> None:
+        self.config = SimpleNamespace(library=library)
+        self._freeze_config = True
+        self.saved = False
+
+    def save_config(self) -> None:
+        self.saved = True
+
+class Client:
+    # just the login steps MultiClient.start goes through
+    def __init__(self, library: Union[str, None] = 'lib') -> None:
+        self.data = Data(library)
+        self.calls: List[str] = []
+
+    def _pre_connect_cli(self, overwrite: bool = False) -> None:
+        self.calls.append('pre')
+
+    def _connect(self) -> None:
+        self.calls.append('connect')
+
+    def _post_connect_cli(self, overwrite: bool = False) -> None:
+        self.calls.append('post')
+
+def start(*clients: Client, overwrite: bool = False) -> MultiClient:
+    multi = MultiClient(list(clients), [None] * len(clients))
+    multi.start(overwrite)
+    for login in multi.logins:
+        login.result()
+    return multi
+
+def test_start_logs_in_every_source():
+    clients = [Client(), Client()]
+    start(*clients)
+    for client in clients:
+        assert client.calls == ['pre', 'connect', 'post']
+        assert client.data.saved and client.data._freeze_config
+
+def test_start_picks_library_when_one_is_missing():
+    clients = [Client(), Client(None)]
+    start(*clients)
+    for client in clients:
+        assert client.calls == ['pre', 'connect', 'post']
+        assert client.data.saved and client.data._freeze_config
+
+def test_start_picks_library_with_overwrite():
+    client = Client()
+    start(client, overwrite=True)
+    assert client.calls == ['pre', 'connect', 'post']
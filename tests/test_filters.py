@@ -0,0 +1,28 @@
+from jellyshuf.filters import Filters, file_key, kind_of, parse_years
+
+def test_parse_years():
+    assert parse_years('1994') == (1994, 1994)
+    assert parse_years('1999-1990') == (1990, 1999)
+    assert parse_years('1990s') == (1990, 1999)
+
+def test_key_round_trips():
+    for filters in (
+        Filters(genre='Rock'),
+        Filters(years=(1990, 1999)),
+        Filters(favorites=True),
+        Filters(min_rating=4),
+        Filters('Drum & Bass?', (1994, 1994), True, 3),
+    ):
+        key = filters.key('songs')
+        assert kind_of(key) == 'songs'
+        assert Filters.from_key(key) == filters
+
+def test_empty_and_artist_keys_are_plain():
+    assert Filters().key('songs') == 'songs'
+    assert Filters(genre='Rock').key('artists') == 'artists'
+    assert Filters.from_key('songs') == Filters()
+
+def test_file_key():
+    key = Filters(genre='a/b').key('albums')
+    assert '/' not in file_key(key) and file_key(key).startswith('albums-')
+    assert file_key('albums') == 'albums'
@@ -0,0 +1,50 @@
+from jellyshuf.resolve import Resolver, fold, fold_path
+
+PREFIX = 'Jellyfin/Music'
+
+def resolver(*entries: str) -> Resolver:
+    return Resolver(PREFIX, sorted(PREFIX + '/' + entry for entry in entries))
+
+def test_fold_ignores_case_accents_and_punctuation():
+    assert fold('Beyoncé') == fold('BEYONCE')
+    assert fold('AC/DC') == fold('ACDC') == 'acdc'
+    assert fold("Guns N' Roses") == fold('Guns N Roses')
+
+def test_fold_moves_trailing_article():
+    assert fold('Beatles, The') == fold('The Beatles')
+    assert fold('Pretender, A') == fold('A Pretender')
+    # only articles are moved
+    assert fold('Crosby, Stills') != fold('Stills Crosby')
+
+def test_fold_path_folds_each_component():
+    assert fold_path('Beatles, The/Abbey Road') == 'thebeatles/abbeyroad'
+
+def test_lookup_exact():
+    r = resolver('Artist', 'Artist/Album', 'Artist/Album/01 Song.flac')
+    assert r.lookup(PREFIX + '/Artist/Album') == PREFIX + '/Artist/Album'
+
+def test_lookup_folded():
+    r = resolver('The Beatles', 'The Beatles/Abbey Road')
+    assert r.lookup(PREFIX + '/Beatles, The/Abbey road') == PREFIX + '/The Beatles/Abbey Road'
+
+def test_lookup_returns_uri_of_tracks_listed_by_uri():
+    r = resolver('Artist/Album/Song\0jellyfin:track:1')
+    assert r.lookup(PREFIX + '/Artist/Album/Song') == 'jellyfin:track:1'
+
+def test_lookup_ambiguous_folded_is_none():
+    r = resolver('Artist/Album', 'ARTIST/album')
+    assert r.lookup(PREFIX + '/artist/ALBUM!') is None
+
+def test_lookup_moved_when_artist_missing():
+    # listed under the track artist instead of the album artist
+    r = resolver('Track Artist', 'Track Artist/Album')
+    assert r.lookup(PREFIX + '/Album Artist/Album') == PREFIX + '/Track Artist/Album'
+
+def test_lookup_not_moved_when_artist_listed():
+    # another artist's album of the same name is not the one asked for
+    r = resolver('X', 'X/Other', 'Y', 'Y/Greatest Hits')
+    assert r.lookup(PREFIX + '/X/Greatest Hits') is None
+
+def test_lookup_miss():
+    r = resolver('Artist', 'Artist/Album')
+    assert r.lookup(PREFIX + '/Artist/Other') is None
@@ -0,0 +1,36 @@
+from jellyshuf.sampling import Cursor, Permutation
+
+def test_permutation_is_a_bijection():
+    for count in (1, 2, 3, 5, 16, 17, 100, 1000, 1025):
+        assert sorted(Permutation(count, 7)) == list(range(count))
+
+def test_permutation_repeats_for_a_seed():
+    assert list(Permutation(100, 7)) == list(Permutation(100, 7))
+    assert list(Permutation(100, 7)) != list(Permutation(100, 8))
+
+def test_cursor_takes_each_item_once_per_run():
+    cursor = Cursor(10, 'lib', 1)
+    assert sorted(cursor.order()) == list(range(10))
+
+def test_cursor_carries_on_where_the_last_run_stopped():
+    first = Cursor(10, 'lib', 1)
+    taken = [i for _, i in zip(range(4), first.order())]
+    second = Cursor.load(first.state(), 10, 'lib')
+    assert second.seed == first.seed and second.position == 4
+    assert taken + [i for _, i in zip(range(6), second.order())] == list(Permutation(10, 1))
+
+def test_cursor_wrap_does_not_repeat_items():
+    # the example from a wrap mid-run: two items are left before a new order starts
+    cursor = Cursor(5, 'lib', 1, 3)
+    order = list(cursor.order())
+    assert sorted(order) == list(range(5))
+    assert order[:2] == [Permutation(5, 1)[3], Permutation(5, 1)[4]]
+    assert cursor.seed != 1
+
+def test_cursor_starts_over_when_the_library_changes():
+    state = Cursor(10, 'lib', 1, 4).state()
+    assert Cursor.load(state, 10, 'lib').position == 4
+    assert Cursor.load(state, 11, 'lib').position == 0
+    assert Cursor.load(state, 10, 'other').position == 0
+    # a given seed always starts from the beginning
+    assert Cursor.load(state, 10, 'lib', 1).position == 0